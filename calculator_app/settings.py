@@ -104,6 +104,76 @@ CHANNEL_LAYERS = {
     },
 }
 
+# With several uvicorn workers (uvicorn --workers / WEB_CONCURRENCY) groups must
+# be shared between processes; core.channel_layers does that through a broker
+# process on a Unix socket that the first worker starts (see core.channel_broker)
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+if WEB_CONCURRENCY > 1 or os.getenv('CHANNEL_BROKER_SOCKET'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.channel_layers.UnixSocketChannelLayer',
+            'CONFIG': {
+                'path': os.getenv('CHANNEL_BROKER_SOCKET', str(BASE_DIR / 'channel_broker.sock')),
+                'capacity': 100,
+                'expiry': 60,
+                'group_expiry': 86400,
+            },
+        },
+    }
+
+# Pre-generated RSA key pairs for registration (see core.key_pool)
+# The pool refills in background processes up to HIGH_WATERMARK once it
+# drops to LOW_WATERMARK, and registration generates inline when it's empty.
+KEY_POOL = {
+    'LOW_WATERMARK': int(os.getenv('KEY_POOL_LOW_WATERMARK', '2')),
+    'HIGH_WATERMARK': int(os.getenv('KEY_POOL_HIGH_WATERMARK', '8')),
+    'WORKERS': int(os.getenv('KEY_POOL_WORKERS', '1')),
+}
+
+# Threads used for RSA/AES work off the request and DB threads (see core.executors)
+CRYPTO_EXECUTOR_WORKERS = int(os.getenv('CRYPTO_EXECUTOR_WORKERS', str(min(8, os.cpu_count() or 1))))
+
+# Maximum number of ciphertexts accepted by /api/decrypt_messages/
+DECRYPT_BATCH_LIMIT = 1000
+
+# Messages per page of /api/messages/<contact_id>/ (see core.utils.conversation_page)
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', '50'))
+MESSAGE_PAGE_SIZE_MAX = 200
+
+# Longest a /api/poll-messages/ request waits for an event, in seconds; keep it
+# under any proxy's idle timeout
+LONG_POLL_TIMEOUT = int(os.getenv('LONG_POLL_TIMEOUT', '25'))
+
+# One-time pre-keys (see core.prekeys)
+ONE_TIME_PREKEYS = {
+    'LOW_WATERMARK': 20,     # owners are told to replenish at or below this many unused keys
+    'BATCH_SIZE': 100,       # keys generated per replenish call by default
+    'MAX_BATCH_SIZE': 500,
+    'CLAIM_CANDIDATES': 8,   # concurrent claimers pick among this many keys to avoid colliding
+    'CLAIM_ATTEMPTS': 5,
+}
+
+# In-process ratchet state cache for ConversationSession (see core.session_cache)
+SESSION_CACHE = {
+    'LEASE_SIZE': 64,        # message numbers reserved per database write
+    'MAX_ENTRIES': 1024,
+    'FLUSH_INTERVAL': 5.0,   # seconds between background flushes
+    'IDLE_SECONDS': 30.0,    # sessions unused this long are written back exactly and evicted
+}
+
+# Group commit for messages saved by the WebSocket consumers (see core.message_writer)
+MESSAGE_WRITER = {
+    'FLUSH_WINDOW': float(os.getenv('MESSAGE_WRITER_FLUSH_WINDOW', '0.005')),  # seconds to gather a batch
+    'MAX_BATCH': int(os.getenv('MESSAGE_WRITER_MAX_BATCH', '100')),            # rows per transaction
+}
+
+# Per-connection outbound WebSocket queues (see core.outbound)
+OUTBOUND_QUEUE = {
+    'MAX_FRAMES': 256,           # frames waiting for a slow client before it is disconnected
+    'MAX_BYTES': 1024 * 1024,
+    'RETRY_AFTER': 5,            # seconds the client is told to wait before reconnecting
+}
+
 # Database
 DATABASES = {
     'default': {
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import UserProfile, Contact, Message, MessageKey
+from .models import UserProfile, Contact, Message, MessageKey, ReadWatermark
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
@@ -13,10 +13,15 @@ class ContactAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'receiver', 'sent_on', 'is_read')
-    list_filter = ('is_read', 'sent_on')
+    list_display = ('sender', 'receiver', 'sent_on')
+    list_filter = ('sent_on',)
     search_fields = ('sender__username', 'receiver__username')
 
+@admin.register(ReadWatermark)
+class ReadWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('reader', 'peer', 'last_read_message_id', 'updated_at')
+    search_fields = ('reader__username', 'peer__username')
+
 @admin.register(MessageKey)
 class MessageKeyAdmin(admin.ModelAdmin):
     list_display = ('user', 'public_key_available')
@@ -3,3 +3,13 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+    
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+        from .encryption import public_key_cache
+        from .metrics import metrics
+        from .models import Contact, MessageKey
+        from .signals import contact_deleted, identity_key_saved
+        metrics.gauge('public_key_cache', public_key_cache.info)
+        post_save.connect(identity_key_saved, sender=MessageKey, dispatch_uid='core.identity_key_saved')
+        post_delete.connect(contact_deleted, sender=Contact, dispatch_uid='core.contact_deleted')
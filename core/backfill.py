@@ -0,0 +1,81 @@
+"""
+Batched conversion of text message ciphertexts into binary payload frames.
+
+Used by migration 0006 and the backfill_message_payloads management command.
+Each batch commits in its own short transaction and only rows without a
+payload are selected, so the backfill can be interrupted and re-run.
+"""
+
+from django.db import transaction
+
+from .encryption import frame_from_ciphertexts, frame_ciphertext
+
+
+def backfill_message_payloads(Message, batch_size=500, log=None):
+    """
+    Convert Message rows that still hold text content into binary payloads
+    Message is passed in so migrations can use their historical model.
+    Rows whose ciphertexts can't share a frame are left as text.
+
+    Returns (converted, skipped)
+    """
+    converted = 0
+    skipped = 0
+    last_id = 0
+    
+    while True:
+        rows = list(
+            Message.objects.filter(payload=None, id__gt=last_id)
+            .exclude(content='')
+            .order_by('id')
+            .values_list('id', 'sender_id', 'receiver_id', 'content', 'sender_copy')[:batch_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        
+        with transaction.atomic():
+            for message_id, sender_id, receiver_id, content, sender_copy in rows:
+                ciphertexts = [(receiver_id, content)]
+                if sender_copy:
+                    ciphertexts.append((sender_id, sender_copy))
+                
+                try:
+                    payload = frame_from_ciphertexts(ciphertexts)
+                except (ValueError, TypeError):
+                    payload = None
+                if payload is None:
+                    skipped += 1
+                    continue
+                
+                Message.objects.filter(id=message_id).update(payload=payload, content='', sender_copy=None)
+                converted += 1
+        
+        if log:
+            log(f'Converted {converted} messages so far (last id {last_id}, {skipped} left as text)')
+    
+    return converted, skipped
+
+
+def restore_message_text(Message, batch_size=500):
+    """
+    Reverse of backfill_message_payloads: write text ciphertexts back from payloads
+    """
+    last_id = 0
+    while True:
+        rows = list(
+            Message.objects.exclude(payload=None).filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', 'sender_id', 'receiver_id', 'payload')[:batch_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        
+        with transaction.atomic():
+            for message_id, sender_id, receiver_id, payload in rows:
+                Message.objects.filter(id=message_id).update(
+                    content=frame_ciphertext(payload, receiver_id) or '',
+                    sender_copy=frame_ciphertext(payload, sender_id),
+                    payload=None,
+                )
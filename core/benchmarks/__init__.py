@@ -0,0 +1,11 @@
+"""
+Benchmarks for the messaging hot paths, run through management commands.
+"""
+
+
+def percentile(values, fraction):
+    """Return the given percentile (0-1) of a list of numbers"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
@@ -0,0 +1,94 @@
+"""
+Concurrent-sender latency for the ChatConsumer send pipeline.
+
+Simulates several WebSocket senders in one event loop. Each message does a
+key lookup and an insert on the thread-sensitive DB executor (simulated with
+a short sleep), plus the envelope encryption, either:
+
+  inline   - inside the DB executor, as ChatConsumer.save_message used to
+  executor - on core.executors.crypto_executor, as it does now
+
+A probe task meanwhile issues trivial DB-executor calls (standing in for
+read receipts and connects of other users) to show how much they get delayed.
+"""
+
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+
+from core.encryption import encrypt_message_frame, generate_key_pair, load_private_key
+from core.executors import crypto_executor
+from . import percentile
+
+
+def _simulated_query(seconds):
+    time.sleep(seconds)
+
+
+async def _run(mode, recipients, senders, messages, size, query_seconds):
+    content = 'x' * size
+    db = sync_to_async(_simulated_query, thread_sensitive=True)
+    
+    def encrypt_inline():
+        _simulated_query(query_seconds)
+        payload = encrypt_message_frame(content, recipients)
+        _simulated_query(query_seconds)
+        return payload
+    
+    send_latencies = []
+    probe_latencies = []
+    
+    async def sender():
+        for _ in range(messages):
+            started = time.perf_counter()
+            if mode == 'inline':
+                await sync_to_async(encrypt_inline, thread_sensitive=True)()
+            else:
+                await db(query_seconds)
+                await asyncio.get_running_loop().run_in_executor(
+                    crypto_executor, encrypt_message_frame, content, recipients
+                )
+                await db(query_seconds)
+            send_latencies.append(time.perf_counter() - started)
+    
+    async def probe(done):
+        while not done.is_set():
+            started = time.perf_counter()
+            await db(0)
+            probe_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.001)
+    
+    done = asyncio.Event()
+    probe_task = asyncio.create_task(probe(done))
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(senders)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probe_task
+    
+    return {
+        'mode': mode,
+        'messages': senders * messages,
+        'throughput': senders * messages / elapsed,
+        'send_p50_ms': percentile(send_latencies, 0.50) * 1000,
+        'send_p99_ms': percentile(send_latencies, 0.99) * 1000,
+        'probe_p50_ms': percentile(probe_latencies, 0.50) * 1000,
+        'probe_p99_ms': percentile(probe_latencies, 0.99) * 1000,
+    }
+
+
+def run(senders=20, messages=50, size=2000, query_ms=0.2):
+    """
+    Run both pipeline modes and return a list of result dicts
+    """
+    # Parsed key objects, as ChatConsumer gets them from the public key cache
+    recipients = {
+        user_id: load_private_key(generate_key_pair()[1]).public_key()
+        for user_id in (1, 2)
+    }
+    
+    return [
+        asyncio.run(_run(mode, recipients, senders, messages, size, query_ms / 1000))
+        for mode in ('inline', 'executor')
+    ]
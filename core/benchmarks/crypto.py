@@ -0,0 +1,184 @@
+"""
+Micro-benchmarks for core.encryption (RSA/AES hybrid) and core.signal_protocol
+(ratchet), so a change to either can be checked for send/receive latency
+regressions.
+
+Each case is timed as `samples` runs of `number` calls; the per-call time of
+each run is one sample, and the median (or min) is what gets compared
+against a baseline. Results are plain dicts so they can be written out as JSON.
+"""
+
+import platform
+import sys
+import time
+
+import cryptography
+
+from core import encryption, signal_protocol
+from . import percentile
+
+MESSAGE_SIZES = (10, 100, 1024, 16 * 1024, 64 * 1024)
+CHAIN_DEPTHS = (1, 100, 10000)
+
+
+def measure(func, samples=20, number=1):
+    """
+    Time func() and return per-call statistics in microseconds
+    """
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    return {
+        'median_us': percentile(timings, 0.50) * 1e6,
+        'p99_us': percentile(timings, 0.99) * 1e6,
+        'min_us': min(timings) * 1e6,
+        'samples': samples,
+        'number': number,
+    }
+
+
+def _session(message_number=0):
+    return {
+        'root_key': signal_protocol.base64_encode(signal_protocol.generate_random_bytes(32)),
+        'chain_key': signal_protocol.base64_encode(signal_protocol.generate_random_bytes(32)),
+        'next_sending_key': signal_protocol.base64_encode(signal_protocol.generate_random_bytes(32)),
+        'message_number': message_number,
+    }
+
+
+def _key_generation_cases(scale):
+    yield 'rsa.generate_key_pair', encryption.generate_key_pair, max(3, 10 // scale), 1
+    yield 'ratchet.generate_identity_key_pair', signal_protocol.generate_identity_key_pair, 20 // scale, 20
+    yield 'ratchet.generate_raw_key_pair', signal_protocol.generate_raw_key_pair, 20 // scale, 50
+
+
+def _rsa_cases(scale):
+    public_key, private_key = encryption.generate_key_pair()
+    parsed_private_key = encryption.load_private_key(private_key)
+    for size in MESSAGE_SIZES:
+        message = 'x' * size
+        ciphertext = encryption.encrypt_message(message, public_key)
+        yield (f'rsa.encrypt_message.{size}b',
+               lambda message=message: encryption.encrypt_message(message, public_key), 20 // scale, 20)
+        yield (f'rsa.decrypt_message.{size}b',
+               lambda ciphertext=ciphertext: encryption.decrypt_message(ciphertext, parsed_private_key),
+               20 // scale, 5)
+
+
+def _ratchet_cases(scale):
+    session = _session()
+    store = signal_protocol.RatchetStateStore()
+    for size in MESSAGE_SIZES:
+        message = 'x' * size
+        encrypted_data, _ = signal_protocol.encrypt_message(message, session)
+        yield (f'ratchet.encrypt_message.{size}b',
+               lambda message=message: signal_protocol.encrypt_message(message, session), 20 // scale, 50)
+        yield (f'ratchet.decrypt_message.{size}b',
+               lambda encrypted_data=encrypted_data: signal_protocol.decrypt_message(encrypted_data, session, store=store),
+               20 // scale, 50)
+
+
+def _session_setup_cases(scale):
+    identity_public, identity_private = signal_protocol.generate_identity_key_pair()
+    signed_public, signed_private, _ = signal_protocol.generate_signed_pre_key(identity_private)
+    one_time_public, _ = signal_protocol.generate_one_time_pre_key()
+    pem_keys = (identity_private, identity_public, signed_private, signed_public,
+                identity_public, signed_public, one_time_public)
+    raw_keys = (
+        signal_protocol.private_key_pem_to_raw(identity_private),
+        signal_protocol.public_key_pem_to_raw(identity_public),
+        signal_protocol.private_key_pem_to_raw(signed_private),
+        signal_protocol.public_key_pem_to_raw(signed_public),
+        signal_protocol.public_key_pem_to_raw(identity_public),
+        signal_protocol.public_key_pem_to_raw(signed_public),
+        signal_protocol.public_key_pem_to_raw(one_time_public),
+    )
+    yield 'ratchet.create_initial_session', lambda: signal_protocol.create_initial_session(*pem_keys), 20 // scale, 50
+    yield 'ratchet.create_initial_session_raw', lambda: signal_protocol.create_initial_session_raw(*raw_keys), 20 // scale, 50
+
+
+def _chain_depth_cases(scale):
+    """
+    Decrypt message n of a chain: cold walks from the chain start with a
+    fresh store, warm looks the key up in a store that has seen the chain
+    """
+    for depth in CHAIN_DEPTHS:
+        session = _session(depth - 1)
+        initial_chain_key = signal_protocol.base64_decode(session['chain_key'])
+        sending_session = dict(session, chain_key=signal_protocol.base64_encode(
+            signal_protocol.advance_chain_key(initial_chain_key, depth - 1)))
+        encrypted_data, _ = signal_protocol.encrypt_message('depth benchmark', sending_session)
+
+        warm_store = signal_protocol.RatchetStateStore()
+        for message_number in range(depth):
+            warm_store.message_key(initial_chain_key, message_number)
+
+        yield (f'ratchet.decrypt_at_depth.{depth}.cold',
+               lambda encrypted_data=encrypted_data, session=session: signal_protocol.decrypt_message(
+                   encrypted_data, session, store=signal_protocol.RatchetStateStore()),
+               10 // scale, 1 if depth > 1000 else 20)
+        yield (f'ratchet.decrypt_at_depth.{depth}.warm',
+               lambda encrypted_data=encrypted_data, session=session, store=warm_store: signal_protocol.decrypt_message(
+                   encrypted_data, session, store=store),
+               20 // scale, 50)
+
+
+CASE_GROUPS = (
+    _key_generation_cases,
+    _rsa_cases,
+    _ratchet_cases,
+    _session_setup_cases,
+    _chain_depth_cases,
+)
+
+
+def environment():
+    return {
+        'python': sys.version.split()[0],
+        'cryptography': cryptography.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+    }
+
+
+def run(only=None, quick=False):
+    """
+    Run every benchmark case (or those whose name contains `only`)
+    Returns {'environment': ..., 'results': {name: stats}}.
+    """
+    scale = 4 if quick else 1
+    results = {}
+    for group in CASE_GROUPS:
+        for name, func, samples, number in group(scale):
+            if only and only not in name:
+                continue
+            results[name] = measure(func, samples=max(samples, 3), number=number)
+    return {
+        'environment': environment(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold=0.10, statistic='median_us'):
+    """
+    Compare one statistic (median by default; min is steadier on noisy
+    machines) against a baseline run
+    Returns a list of (name, baseline_us, current_us, change) for every case
+    present in both, where change is the relative difference (0.25 = 25%
+    slower), and the list of names that regressed by more than threshold.
+    """
+    rows = []
+    regressions = []
+    for name, stats in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        change = stats[statistic] / before[statistic] - 1 if before[statistic] else 0.0
+        rows.append((name, before[statistic], stats[statistic], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
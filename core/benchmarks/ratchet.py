@@ -0,0 +1,77 @@
+"""
+Receiving-chain key lookup cost in signal_protocol.decrypt_message.
+
+For each chain depth n this measures:
+  linear      - the old approach: walk n HMAC steps from the chain start
+                to reach message n (replaying a conversation is O(n^2))
+  replay      - decrypting messages 0..n-1 in order through a RatchetStateStore
+  random      - p50/p99 lookup of random messages once checkpoints exist
+  decrypt     - full decrypt_message of the newest message
+"""
+
+import random
+import time
+
+from cryptography.hazmat.primitives import hashes, hmac
+
+from core import signal_protocol
+from . import percentile
+
+
+def _linear_chain_key(chain_key, steps):
+    # The pre-checkpoint loop from decrypt_message
+    for _ in range(steps):
+        h = hmac.HMAC(chain_key, hashes.SHA256())
+        h.update(b"chain_key_update")
+        chain_key = h.finalize()
+    return chain_key
+
+
+def run_depth(depth, samples=1000):
+    initial_chain_key = signal_protocol.generate_random_bytes(32)
+    store = signal_protocol.RatchetStateStore()
+    
+    started = time.perf_counter()
+    _linear_chain_key(initial_chain_key, depth - 1)
+    linear_seconds = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for message_number in range(depth):
+        store.message_key(initial_chain_key, message_number)
+    replay_seconds = time.perf_counter() - started
+    
+    lookups = []
+    for message_number in random.sample(range(depth), min(samples, depth)):
+        started = time.perf_counter()
+        store.chain_key_at(initial_chain_key, message_number)
+        lookups.append(time.perf_counter() - started)
+    
+    # Encrypt the newest message from the chain state at depth - 1, then decrypt it
+    session = {
+        'root_key': signal_protocol.base64_encode(signal_protocol.generate_random_bytes(32)),
+        'chain_key': signal_protocol.base64_encode(store.chain_key_at(initial_chain_key, depth - 1)),
+        'next_sending_key': signal_protocol.base64_encode(signal_protocol.generate_random_bytes(32)),
+        'message_number': depth - 1,
+    }
+    encrypted_data, _ = signal_protocol.encrypt_message('benchmark message', session)
+    session['chain_key'] = signal_protocol.base64_encode(initial_chain_key)
+    started = time.perf_counter()
+    plaintext, _ = signal_protocol.decrypt_message(encrypted_data, session, store=store)
+    decrypt_seconds = time.perf_counter() - started
+    assert plaintext == 'benchmark message'
+    
+    return {
+        'depth': depth,
+        'linear_ms': linear_seconds * 1000,
+        # Replaying with the linear walk costs sum(0..n-1) steps
+        'linear_replay_estimate_s': linear_seconds / max(depth - 1, 1) * depth * (depth - 1) / 2,
+        'replay_s': replay_seconds,
+        'replay_per_message_us': replay_seconds / depth * 1e6,
+        'random_p50_us': percentile(lookups, 0.50) * 1e6,
+        'random_p99_us': percentile(lookups, 0.99) * 1e6,
+        'decrypt_us': decrypt_seconds * 1e6,
+    }
+
+
+def run(depths=(10000, 100000, 1000000)):
+    return [run_depth(depth) for depth in depths]
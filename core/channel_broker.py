@@ -0,0 +1,225 @@
+"""
+Channel layer broker shared by the worker processes on one host.
+
+Channels' InMemoryChannelLayer only reaches consumers in its own process, so
+with several uvicorn workers a group_send from one worker never reaches
+sockets held by another. The broker is a small asyncio process that owns a
+single InMemoryChannelLayer (and with it the usual expiry, group expiry and
+capacity behaviour) and serves it over a Unix domain socket to
+core.channel_layers.UnixSocketChannelLayer in each worker.
+
+Wire format: every frame is a 4-byte big-endian length followed by a UTF-8
+JSON object. Requests carry an `op` (hello, send, receive, cancel, group_add,
+group_discard, group_send, flush) and an `id`; the reply echoes the id with
+either `result` or `error`. Receives are answered whenever a message arrives,
+so replies can come back out of order; a client that stops waiting sends
+`{"op": "cancel", "target": id}`.
+
+Workers start the broker themselves the first time they can't connect (see
+UnixSocketChannelLayer). An exclusive flock on `<path>.lock` makes sure only
+one broker runs per socket path; a broker exits after `idle_timeout` seconds
+without clients.
+
+Run by hand with: python -m core.channel_broker --path /tmp/channels.sock
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import struct
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+async def read_frame(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return json.loads(await reader.readexactly(length))
+
+
+def encode_frame(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(data)) + data
+
+
+class Broker:
+    def __init__(self, path, idle_timeout=600, expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.layer = InMemoryChannelLayer(expiry=expiry, group_expiry=group_expiry, capacity=capacity)
+        # InMemoryChannelLayer keeps the raw dict; get_capacity expects compiled patterns
+        self.layer.channel_capacity = self.layer.compile_capacities(channel_capacity or {})
+        # Lets clients tell a restarted broker (with empty groups) from the one they knew
+        self.instance_id = os.urandom(8).hex()
+        self.clients = 0
+        self.idle_since = None
+        self.server = None
+
+    async def _reply(self, writer, lock, payload):
+        async with lock:
+            writer.write(encode_frame(payload))
+            await writer.drain()
+
+    async def _receive(self, writer, lock, request_id, channel, pending, owned):
+        try:
+            message = await self.layer.receive(channel)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._reply(writer, lock, {'id': request_id, 'error': 'invalid', 'message': str(e)})
+        else:
+            await self._reply(writer, lock, {'id': request_id, 'result': message})
+        finally:
+            pending.pop(request_id, None)
+            # Forget channels nobody is waiting on and nothing is queued for,
+            # so one-off channels (long polls) don't pile up for the client's lifetime
+            owned[channel] -= 1
+            if not owned[channel] and channel not in self.layer.channels:
+                del owned[channel]
+
+    async def _call(self, request):
+        op = request['op']
+        if op == 'hello':
+            return self.instance_id
+        if op == 'send':
+            await self.layer.send(request['channel'], request['message'])
+        elif op == 'group_add':
+            await self.layer.group_add(request['group'], request['channel'])
+        elif op == 'group_discard':
+            await self.layer.group_discard(request['group'], request['channel'])
+        elif op == 'group_send':
+            await self.layer.group_send(request['group'], request['message'])
+        elif op == 'flush':
+            await self.layer.flush()
+        else:
+            raise ValueError(f"Unknown op {op!r}")
+
+    async def handle_client(self, reader, writer):
+        self.clients += 1
+        lock = asyncio.Lock()
+        pending = {}
+        # Channels this client receives on (with their outstanding receives); they die with the client
+        owned = {}
+        try:
+            while True:
+                request = await read_frame(reader)
+                op = request.get('op')
+                request_id = request.get('id')
+
+                if op == 'receive':
+                    channel = request['channel']
+                    owned[channel] = owned.get(channel, 0) + 1
+                    pending[request_id] = asyncio.create_task(
+                        self._receive(writer, lock, request_id, channel, pending, owned)
+                    )
+                    continue
+
+                if op == 'cancel':
+                    task = pending.pop(request.get('target'), None)
+                    if task is not None:
+                        task.cancel()
+                    continue
+
+                # Everything else is handled in order, so one client's sends
+                # and group changes are applied in the order it made them
+                try:
+                    reply = {'id': request_id, 'result': await self._call(request)}
+                except ChannelFull:
+                    reply = {'id': request_id, 'error': 'full'}
+                except (AssertionError, TypeError, ValueError, KeyError) as e:
+                    reply = {'id': request_id, 'error': 'invalid', 'message': str(e)}
+                await self._reply(writer, lock, reply)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError:
+            logger.exception("Dropping client after a bad frame")
+        finally:
+            for task in pending.values():
+                task.cancel()
+            for channel in owned:
+                self.layer._remove_from_groups(channel)
+                self.layer.channels.pop(channel, None)
+            writer.close()
+            self.clients -= 1
+
+    async def _housekeeping(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(5)
+            # The in-memory layer only expires messages and group members
+            # when it is used; make sure idle groups expire too
+            self.layer._clean_expired()
+
+            if self.clients:
+                self.idle_since = None
+            elif self.idle_since is None:
+                self.idle_since = loop.time()
+            elif self.idle_timeout and loop.time() - self.idle_since > self.idle_timeout:
+                logger.info("Channel broker idle for %ss, exiting", self.idle_timeout)
+                return
+
+    async def serve(self):
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+        os.chmod(self.path, 0o600)
+        try:
+            await self._housekeeping()
+        finally:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def acquire_lock(path):
+    """
+    Take the exclusive broker lock for a socket path
+    Returns the open lock file, or None if another broker holds it.
+    """
+    lock_file = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Channel layer broker for multi-process workers')
+    parser.add_argument('--path', required=True, help='Unix socket path')
+    parser.add_argument('--config', default='{}',
+                        help='JSON layer config: expiry, group_expiry, capacity, channel_capacity, idle_timeout')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s channel_broker %(levelname)s %(message)s')
+
+    lock_file = acquire_lock(args.path)
+    if lock_file is None:
+        # Another worker's broker won the race
+        return 0
+
+    # Holding the lock means any socket file left behind is stale
+    if os.path.exists(args.path):
+        os.unlink(args.path)
+
+    broker = Broker(args.path, **json.loads(args.config))
+    try:
+        asyncio.run(broker.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lock_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,277 @@
+"""
+Channel layer backed by a per-host broker process (core.channel_broker).
+
+Use it when running more than one uvicorn worker: group membership and
+channel queues live in the broker, so group_send from any worker reaches
+consumers in every worker. Nothing outside this app is needed; the first
+worker that can't connect starts the broker itself.
+
+Messages travel as JSON, so they must be JSON-serializable (the events this
+app sends are). Delivery is at most once, like the in-memory layer: a message
+the broker hands out just as its receiver goes away is dropped.
+"""
+
+import asyncio
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+import weakref
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .channel_broker import encode_frame, read_frame
+
+
+class BrokerConnectionLost(ConnectionError):
+    pass
+
+
+class _BrokerConnection:
+    """
+    One socket to the broker, used by a single event loop
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.write_lock = asyncio.Lock()
+        self.reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+
+    async def _read_replies(self):
+        try:
+            while True:
+                reply = await read_frame(self.reader)
+                future = self.pending.pop(reply.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(BrokerConnectionLost("Lost connection to the channel broker"))
+            self.pending.clear()
+
+    async def _write(self, payload):
+        async with self.write_lock:
+            self.writer.write(encode_frame(payload))
+            await self.writer.drain()
+
+    async def request(self, op, **fields):
+        if self.closed:
+            raise BrokerConnectionLost("Lost connection to the channel broker")
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self._write(dict(fields, op=op, id=request_id))
+            reply = await future
+        except asyncio.CancelledError:
+            if self.pending.pop(request_id, None) is not None and not self.closed:
+                # Stop the broker waiting on our behalf
+                try:
+                    await asyncio.shield(self._write({'op': 'cancel', 'target': request_id}))
+                except (ConnectionError, asyncio.CancelledError):
+                    pass
+            raise
+        except ConnectionError as e:
+            self.pending.pop(request_id, None)
+            raise BrokerConnectionLost(str(e)) from e
+
+        error = reply.get('error')
+        if error == 'full':
+            raise ChannelFull(fields.get('channel'))
+        if error:
+            raise TypeError(reply.get('message', error))
+        return reply.get('result')
+
+    async def close(self):
+        self.closed = True
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer whose groups and queues are shared by all processes that
+    use the same socket path
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 spawn_broker=True, broker_idle_timeout=600, connect_timeout=10.0, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.spawn_broker = spawn_broker
+        self.connect_timeout = connect_timeout
+        self.broker_config = {
+            'expiry': expiry,
+            'group_expiry': group_expiry,
+            'capacity': capacity,
+            'channel_capacity': channel_capacity or {},
+            'idle_timeout': broker_idle_timeout,
+        }
+        self.client_prefix = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        # Event loop -> connection; async_to_sync gives each call its own loop
+        self._connections = weakref.WeakKeyDictionary()
+        # group -> {channel: joined_at}, replayed to a restarted broker
+        self._memberships = {}
+        self._broker_id = None
+        self._broker_process = None
+
+    # Connection management
+
+    def _start_broker(self):
+        if self._broker_process is not None and self._broker_process.poll() is None:
+            return
+        project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self._broker_process = subprocess.Popen(
+            [sys.executable, '-m', 'core.channel_broker',
+             '--path', self.path, '--config', json.dumps(self.broker_config)],
+            cwd=project_dir,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        started = False
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not self.spawn_broker or loop.time() > deadline:
+                    raise
+                if not started:
+                    self._start_broker()
+                    started = True
+                await asyncio.sleep(0.05)
+
+        connection = _BrokerConnection(reader, writer)
+        broker_id = await connection.request('hello')
+        if self._broker_id is not None and broker_id != self._broker_id:
+            # A new broker started with no groups; restore this process's memberships
+            cutoff = time.time() - self.group_expiry
+            for group, channels in list(self._memberships.items()):
+                for channel, joined_at in list(channels.items()):
+                    if joined_at >= cutoff:
+                        await connection.request('group_add', group=group, channel=channel)
+        self._broker_id = broker_id
+        return connection
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None or connection.closed:
+            connection = await self._open()
+            if loop not in self._connections:
+                self._close_with_loop(loop)
+            self._connections[loop] = connection
+        return connection
+
+    def _close_with_loop(self, loop):
+        """
+        Close the loop's connection before the loop itself closes, so the
+        short-lived loops async_to_sync creates don't leak sockets
+        """
+        original_close = loop.close
+        layer = self
+
+        def close():
+            connection = layer._connections.pop(loop, None)
+            if connection is not None and not loop.is_closed():
+                loop.run_until_complete(connection.close())
+            original_close()
+
+        loop.close = close
+
+    # Safe to repeat if the connection drops after the broker applied them
+    IDEMPOTENT_OPS = ('group_add', 'group_discard', 'flush')
+
+    async def _request(self, op, **fields):
+        connection = await self._connection()
+        try:
+            return await connection.request(op, **fields)
+        except BrokerConnectionLost:
+            if op not in self.IDEMPOTENT_OPS:
+                raise
+            # One retry on a fresh connection (starting the broker again if needed)
+            connection = await self._connection()
+            return await connection.request(op, **fields)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        await self._request('send', channel=channel, message=message)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        while True:
+            try:
+                return await self._request('receive', channel=channel)
+            except BrokerConnectionLost:
+                # The broker went away while we waited; wait on the new one
+                await asyncio.sleep(0.05)
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.%s!%s' % (
+            prefix,
+            self.client_prefix,
+            ''.join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    # Flush extension
+
+    async def flush(self):
+        self._memberships = {}
+        await self._request('flush')
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.pop(loop, None)
+        if connection is not None:
+            await connection.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._memberships.setdefault(group, {})[channel] = time.time()
+        await self._request('group_add', group=group, channel=channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        channels = self._memberships.get(group)
+        if channels is not None:
+            channels.pop(channel, None)
+            if not channels:
+                del self._memberships[group]
+        await self._request('group_discard', group=group, channel=channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._request('group_send', group=group, message=message)
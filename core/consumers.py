@@ -1,17 +1,183 @@
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
 from django.db.models import Q
-from django.utils import timezone
-from .models import Message, Contact, MessageKey
-from .encryption import encrypt_message, decrypt_message
-from .signal_protocol import generate_security_verification_code, generate_qr_verification_data
+from .models import Contact, MessageKey, ReadWatermark
+from .encryption import encrypt_message_frame
+from .executors import crypto_executor
+from .message_writer import message_writer
+from .outbound import OutboundQueueMixin
+from .signal_protocol import generate_qr_verification_data
 
-class ChatConsumer(AsyncWebsocketConsumer):
+def chat_group_name(user_id, contact_id):
+    """
+    Group shared by both participants' per-conversation sockets
+    """
+    user_ids = sorted([int(user_id), int(contact_id)])
+    return f'chat_{user_ids[0]}_{user_ids[1]}'
+
+
+def user_group_name(user_id):
+    """
+    Group joined by every per-user socket a user has open
+    """
+    return f'user_{user_id}'
+
+
+async def group_send_many(channel_layer, groups, event):
+    for group in groups:
+        await channel_layer.group_send(group, event)
+
+
+async def broadcast_conversation_event(channel_layer, user_id, contact_id, event):
+    """
+    Deliver a conversation event to the per-conversation group and to both
+    participants' user groups
+    """
+    await group_send_many(
+        channel_layer,
+        (chat_group_name(user_id, contact_id), user_group_name(user_id), user_group_name(contact_id)),
+        event
+    )
+
+
+class ConversationContext:
+    """
+    What a connection needs to send in one conversation, loaded once
+    """
+    def __init__(self, contact_user, contact, recipients):
+        self.contact_user = contact_user
+        self.contact = contact
+        # user id -> parsed public key for everyone the content key is wrapped for
+        self.recipients = recipients
+
+
+class ConversationMixin:
+    """
+    Sending and read receipts shared by the per-conversation and per-user consumers
+    Each connection keeps a ConversationContext per contact it talks to, so a
+    message costs one INSERT rather than re-reading the contact and both keys.
+    Contexts are dropped when a key_rotated or contact_removed event arrives.
+    """
+    async def get_context(self, contact_id):
+        """
+        Return the contact's ConversationContext, or None if they aren't a contact
+        """
+        contact_id = int(contact_id)
+        if contact_id not in self.contexts:
+            context = await self.load_context(contact_id)
+            if context is None:
+                # Not cached, so a contact added later is still picked up
+                return None
+            self.contexts[contact_id] = context
+        return self.contexts[contact_id]
+    
+    @database_sync_to_async
+    def load_context(self, contact_id):
+        contact = Contact.objects.filter(
+            owner=self.user, contact_user_id=contact_id
+        ).select_related('contact_user').first()
+        if contact is None:
+            return None
+        
+        # Wrap the content key for the receiver, and for ourselves so we can
+        # read our own message later
+        recipients = {}
+        for key in MessageKey.objects.filter(user_id__in=[contact_id, self.user.id]):
+            recipients[key.user_id] = key.load_public_key()
+        return ConversationContext(contact.contact_user, contact, recipients)
+    
+    async def key_rotated(self, event):
+        # A participant's identity key changed; reload the keys on next use
+        user_id = event['user_id']
+        if user_id == self.user.id:
+            self.contexts.clear()
+        else:
+            self.contexts.pop(user_id, None)
+    
+    async def send_chat_message(self, contact_id, content):
+        # Save message to database and get the message object
+        message_data = await self.encrypt_and_save_message(contact_id, content)
+        
+        # Send message to the conversation if successful
+        if 'error' not in message_data:
+            await broadcast_conversation_event(
+                self.channel_layer, self.user.id, contact_id,
+                {
+                    'type': 'chat_message',
+                    'message': content,
+                    'sender_id': self.user.id,
+                    'receiver_id': int(contact_id),
+                    'message_id': message_data['message_id'],
+                    'timestamp': message_data['timestamp'].isoformat(),
+                }
+            )
+    
+    async def send_read_receipt(self, contact_id, up_to):
+        """
+        Mark every message from the contact up to message `up_to` as read
+        One watermark write and one broadcast however many messages it covers.
+        """
+        try:
+            up_to = int(up_to)
+        except (TypeError, ValueError):
+            return
+        
+        # Send read receipt to the conversation if the watermark moved
+        if await self.advance_read_watermark(contact_id, up_to):
+            await broadcast_conversation_event(
+                self.channel_layer, self.user.id, contact_id,
+                {
+                    'type': 'read_receipt',
+                    'up_to': up_to,
+                    'reader_id': self.user.id,
+                    'sender_id': int(contact_id),
+                }
+            )
+    
+    async def encrypt_and_save_message(self, contact_id, content):
+        """
+        Encrypt on the crypto executor and only use the DB thread for queries
+        database_sync_to_async runs everything on one shared thread, so doing
+        RSA work there would stall every other consumer's ORM calls.
+        """
+        context = await self.get_context(contact_id)
+        if context is None:
+            return {'error': 'Invalid contact'}
+        if context.contact_user.id not in context.recipients:
+            return {'error': 'Receiver has no encryption key'}
+        
+        # Encrypt the message once for both participants
+        payload = await asyncio.get_running_loop().run_in_executor(
+            crypto_executor, encrypt_message_frame, content, context.recipients
+        )
+        
+        # Save the encrypted message; the writer commits it together with
+        # whatever other consumers are saving right now
+        message_id, sent_on = await message_writer.write(
+            sender_id=self.user.id,
+            receiver_id=context.contact_user.id,
+            payload=payload
+        )
+        return {
+            'message_id': message_id,
+            'content': content,  # Return the original content for the sender
+            'timestamp': sent_on
+        }
+    
+    @database_sync_to_async
+    def advance_read_watermark(self, contact_id, up_to):
+        # Only messages the current user received can be marked as read
+        return ReadWatermark.advance(self.user.id, contact_id, up_to)
+
+
+class ChatConsumer(ConversationMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope['user']
-        self.contact_id = self.scope['url_route']['kwargs']['contact_id']
+        self.contact_id = int(self.scope['url_route']['kwargs']['contact_id'])
+        self.contexts = {}
         
         # Check if user is authenticated
         if not self.user.is_authenticated:
@@ -26,10 +192,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
-        # Check if contact exists
+        # Check the contact exists and load the keys for this connection
         try:
-            contact_exists = await self.check_contact_exists()
-            if not contact_exists:
+            context = await self.get_context(self.contact_id)
+            if context is None:
                 # Close connection if contact does not exist
                 await self.close()
                 return
@@ -39,8 +205,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         
         # Create a unique room name for this chat
-        user_ids = sorted([self.user.id, int(self.contact_id)])
-        self.room_group_name = f'chat_{user_ids[0]}_{user_ids[1]}'
+        self.room_group_name = chat_group_name(self.user.id, self.contact_id)
         
         # Join room group
         await self.channel_layer.group_add(
@@ -48,9 +213,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
+        self.open_outbound()
         await self.accept()
     
     async def disconnect(self, close_code):
+        self.close_outbound()
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -64,139 +232,149 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         if message_type == 'chat_message':
             # Handle new chat message
-            content = text_data_json.get('message')
-            
             try:
-                # Save message to database and get the message object
-                message_data = await self.save_message(content)
-                
-                # Send message to room group if successful
-                if 'error' not in message_data:
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': content if self.user.id == self.scope["user"].id else message_data['content'],
-                            'sender_id': self.user.id,
-                            'message_id': message_data['message_id'],
-                            'timestamp': message_data['timestamp'].isoformat(),
-                        }
-                    )
+                await self.send_chat_message(self.contact_id, text_data_json.get('message'))
             except Exception as e:
                 print(f"Error sending message: {str(e)}")
         elif message_type == 'read_receipt':
             # Handle read receipt
-            message_id = text_data_json.get('message_id')
-            
             try:
-                # Mark message as read
-                read_success = await self.mark_message_read(message_id)
-                
-                # Send read receipt to room group if successfully marked as read
-                if read_success:
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'read_receipt',
-                            'message_id': message_id,
-                            'reader_id': self.user.id,
-                        }
-                    )
+                # Older clients name a single message instead of a range
+                up_to = text_data_json.get('up_to', text_data_json.get('message_id'))
+                await self.send_read_receipt(self.contact_id, up_to)
             except Exception as e:
                 print(f"Error marking message as read: {str(e)}")
     
     # Receive message from room group
     async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        # Queue message for the WebSocket
+        self.queue_frame({
             'type': 'chat_message',
             'message': event['message'],
             'sender_id': event['sender_id'],
             'message_id': event['message_id'],
             'timestamp': event['timestamp'],
-        }))
+        })
     
     # Receive read receipt from room group
     async def read_receipt(self, event):
-        # Send read receipt to WebSocket
-        await self.send(text_data=json.dumps({
+        # Queue read receipt for the WebSocket; a newer one from the same
+        # reader replaces it if the client hasn't taken it yet.
+        # message_id is kept for clients that mark single messages
+        self.queue_frame({
             'type': 'read_receipt',
-            'message_id': event['message_id'],
+            'up_to': event['up_to'],
+            'message_id': event['up_to'],
             'reader_id': event['reader_id'],
-        }))
+        }, coalesce_key=('read_receipt', event['reader_id']))
     
-    @database_sync_to_async
-    def check_contact_exists(self):
-        try:
-            contact_user = User.objects.get(id=self.contact_id)
-            return Contact.objects.filter(owner=self.user, contact_user=contact_user).exists()
-        except User.DoesNotExist:
-            return False
+    # Receive contact removal from room group
+    async def contact_removed(self, event):
+        # Only the owner of the removed contact loses access to the conversation
+        if event['owner_id'] == self.user.id:
+            self.contexts.clear()
+            await self.close()
+
+
+class UserConsumer(ConversationMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
+    """
+    One socket per signed-in user carrying all of their conversations
+    Every frame names its conversation in `contact_id`, so the client can
+    switch conversations, and keep unread counts for the others current,
+    without reconnecting.
+    """
+    async def connect(self):
+        self.user = self.scope['user']
+        self.group_name = None
+        self.contexts = {}
+        
+        # Check if user is authenticated
+        if not self.user.is_authenticated:
+            # Close connection if user is not authenticated
+            await self.close()
+            return
+        
+        # Check if calculator_verified is in session
+        session = self.scope['session']
+        if not session.get('calculator_verified', False):
+            # Close connection if user is not verified through calculator
+            await self.close()
+            return
+        
+        # Join the user's group; events for all of their conversations arrive here
+        self.group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+        
+        self.open_outbound()
+        await self.accept()
     
-    @database_sync_to_async
-    def save_message(self, content):
-        try:
-            # Get contact user
-            contact_user = User.objects.get(id=self.contact_id)
-            
-            # Get receiver's public key
-            receiver_key = MessageKey.objects.get(user=contact_user)
-            
-            # Encrypt the message with receiver's public key
-            encrypted_content = encrypt_message(content, receiver_key.public_key)
-            
-            # Save the encrypted message
-            message = Message.objects.create(
-                sender=self.user,
-                receiver=contact_user,
-                content=encrypted_content,
-                is_read=False,
-                sent_on=timezone.now()
+    async def disconnect(self, close_code):
+        self.close_outbound()
+        
+        # Leave user group
+        if self.group_name:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
             )
-            
-            # IMPROVEMENT: For better user experience, also save a special copy for self
-            # Get our own public key
-            try:
-                own_key = MessageKey.objects.get(user=self.user)
-                # Encrypt with our own public key so we can decrypt it later
-                self_encrypted = encrypt_message(content, own_key.public_key)
-                
-                # Save a special "sent to self" message that we can decrypt later
-                Message.objects.create(
-                    sender=contact_user,  # Trick: mark it as if it came from receiver
-                    receiver=self.user,  # To self
-                    content=self_encrypted,
-                    is_read=True,  # Already read
-                    sent_on=message.sent_on  # Same timestamp to match
-                )
-            except MessageKey.DoesNotExist:
-                # Not critical if this fails, user will still see encrypted message
-                pass
-                
-            return {
-                'message_id': message.id,
-                'content': content,  # Return the original content for the sender
-                'timestamp': message.sent_on
-            }
-        except User.DoesNotExist:
-            return {'error': 'User does not exist'}
-        except MessageKey.DoesNotExist:
-            return {'error': 'Receiver has no encryption key'}
     
-    @database_sync_to_async
-    def mark_message_read(self, message_id):
+    # Receive message from WebSocket
+    async def receive(self, text_data):
         try:
-            # Only mark messages as read if the current user is the receiver
-            message = Message.objects.get(
-                id=message_id,
-                receiver=self.user,
-                is_read=False
-            )
-            message.is_read = True
-            message.save()
-            return True
-        except Message.DoesNotExist:
-            return False
+            text_data_json = json.loads(text_data)
+            contact_id = int(text_data_json.get('contact_id'))
+        except (ValueError, TypeError):
+            return
+        
+        # Ignore frames for conversations the user doesn't have
+        if await self.get_context(contact_id) is None:
+            return
+        
+        message_type = text_data_json.get('type')
+        if message_type == 'chat_message':
+            # Handle new chat message
+            try:
+                await self.send_chat_message(contact_id, text_data_json.get('message'))
+            except Exception as e:
+                print(f"Error sending message: {str(e)}")
+        elif message_type == 'read_receipt':
+            # Handle read receipt
+            try:
+                await self.send_read_receipt(contact_id, text_data_json.get('up_to'))
+            except Exception as e:
+                print(f"Error marking message as read: {str(e)}")
+    
+    # Receive message from user group
+    async def chat_message(self, event):
+        # The conversation is named by the other participant
+        sender_id = event['sender_id']
+        self.queue_frame({
+            'type': 'chat_message',
+            'contact_id': event['receiver_id'] if sender_id == self.user.id else sender_id,
+            'message': event['message'],
+            'sender_id': sender_id,
+            'message_id': event['message_id'],
+            'timestamp': event['timestamp'],
+        })
+    
+    # Receive read receipt from user group
+    async def read_receipt(self, event):
+        # Receipts coalesce per conversation and reader, see core.outbound
+        reader_id = event['reader_id']
+        contact_id = event['sender_id'] if reader_id == self.user.id else reader_id
+        self.queue_frame({
+            'type': 'read_receipt',
+            'contact_id': contact_id,
+            'up_to': event['up_to'],
+            'reader_id': reader_id,
+        }, coalesce_key=('read_receipt', contact_id, reader_id))
+    
+    # Receive contact removal from user group
+    async def contact_removed(self, event):
+        self.contexts.pop(event['contact_user_id'], None)
 
 
 class SecurityVerificationConsumer(AsyncWebsocketConsumer):
@@ -299,22 +477,17 @@ class SecurityVerificationConsumer(AsyncWebsocketConsumer):
             contact_user = User.objects.get(id=self.contact_id)
             contact_key = MessageKey.objects.get(user=contact_user)
             
-            # Generate or get security code
-            if not self.contact.security_code:
-                security_code = generate_security_verification_code(
-                    user_key.public_key, 
-                    contact_key.public_key
-                )
-                self.contact.security_code = security_code
-                self.contact.save()
+            # Get the security code (derived from the stored key fingerprints once)
+            security_code = self.contact.ensure_security_code(user_key, contact_key)
             
             # Generate QR code data
             qr_data = generate_qr_verification_data(
                 user_key.public_key,
-                contact_key.public_key
+                contact_key.public_key,
+                security_code=security_code
             )
             
-            return self.contact.security_code, qr_data
+            return security_code, qr_data
         except (User.DoesNotExist, MessageKey.DoesNotExist):
             return "Encryption keys not available", ""
     
@@ -1,7 +1,12 @@
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from collections import OrderedDict
 import base64
+import os
+import struct
+import threading
 
 def generate_key_pair():
     """
@@ -32,50 +37,321 @@ def generate_key_pair():
     
     return public_key_pem, private_key_pem
 
-def encrypt_message(message, public_key_pem):
+# Envelope format version prefixes. Legacy ciphertexts are a '|'-joined list of
+# base64 RSA chunks and never contain ':', so the prefixes are unambiguous.
+ENVELOPE_VERSION = 'v2'
+MULTI_RECIPIENT_VERSION = 'v3'
+
+# AES-256-GCM content key and 96-bit nonce used by the hybrid format
+CONTENT_KEY_SIZE = 32
+NONCE_SIZE = 12
+
+def _oaep_padding():
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+class PublicKeyCache:
     """
-    Encrypt a message using the recipient's public key
+    Bounded, thread-safe LRU of parsed public key objects
+    Callers key entries by something that changes when the key is rotated
+    (e.g. MessageKey pk and updated_at), so stale entries are never returned.
     """
-    # Load the public key
-    public_key = serialization.load_pem_public_key(
-        public_key_pem.encode('utf-8'),
-        backend=default_backend()
-    )
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
     
-    # Due to RSA limitations, we need to chunk the message
-    # if it's longer than the max allowed size
-    message_bytes = message.encode('utf-8')
-    
-    # For RSA 2048, max size is around 245 bytes per chunk
-    chunk_size = 245
-    chunks = [message_bytes[i:i + chunk_size] for i in range(0, len(message_bytes), chunk_size)]
-    
-    encrypted_chunks = []
-    for chunk in chunks:
-        encrypted = public_key.encrypt(
-            chunk,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
+    def get(self, cache_key, public_key_pem):
+        with self._lock:
+            public_key = self._keys.get(cache_key)
+            if public_key is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return public_key
+            self.misses += 1
+        
+        # Parse outside the lock; a concurrent miss on the same key just parses twice
+        public_key = serialization.load_pem_public_key(
+            public_key_pem.encode('utf-8'),
+            backend=default_backend()
         )
-        # Base64 encode each encrypted chunk
-        encrypted_chunks.append(base64.b64encode(encrypted).decode('utf-8'))
+        
+        with self._lock:
+            self._keys[cache_key] = public_key
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return public_key
     
-    # Join chunks with delimiter
-    return '|'.join(encrypted_chunks)
+    def info(self):
+        """
+        Return hit/miss counters and current size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._keys),
+                'maxsize': self.maxsize,
+            }
+    
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
 
-def decrypt_message(encrypted_message, private_key_pem):
+# Process-wide cache used by MessageKey.load_public_key()
+public_key_cache = PublicKeyCache()
+
+def _load_public_key(public_key):
+    # Load the public key unless the caller passed a parsed one
+    if isinstance(public_key, str):
+        return serialization.load_pem_public_key(
+            public_key.encode('utf-8'),
+            backend=default_backend()
+        )
+    return public_key
+
+def _seal(message):
     """
-    Decrypt a message using the recipient's private key
+    Encrypt the body with a fresh symmetric key
+    Returns (content_key, nonce, ciphertext)
+    """
+    content_key = AESGCM.generate_key(bit_length=CONTENT_KEY_SIZE * 8)
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = AESGCM(content_key).encrypt(nonce, message.encode('utf-8'), None)
+    return content_key, nonce, ciphertext
+
+def _b64(data):
+    return base64.b64encode(data).decode('utf-8')
+
+def encrypt_message(message, public_key):
+    """
+    Encrypt a message using the recipient's public key
+    public_key is either a PEM string or an already loaded key object
+
+    A random AES-GCM content key encrypts the body and is itself wrapped once
+    with RSA-OAEP, so the RSA cost is constant per message whatever its length.
+    Returns 'v2:<wrapped_key>:<nonce>:<ciphertext>' (each part base64 encoded).
+    """
+    content_key, nonce, ciphertext = _seal(message)
+    
+    # Wrap the content key for the recipient
+    wrapped_key = _load_public_key(public_key).encrypt(content_key, _oaep_padding())
+    
+    return ':'.join([ENVELOPE_VERSION, _b64(wrapped_key), _b64(nonce), _b64(ciphertext)])
+
+def encrypt_message_for_recipients(message, recipients):
+    """
+    Encrypt a message once for several recipients
+    recipients maps a recipient id (e.g. user id) to their public key.
+
+    The body is encrypted a single time and the content key is wrapped per
+    recipient. Returns 'v3:<id>.<wrapped_key>,...:<nonce>:<ciphertext>'.
+    """
+    content_key, nonce, ciphertext = _seal(message)
+    
+    # Wrap the same content key once per recipient
+    wrapped_keys = []
+    for recipient_id, public_key in recipients.items():
+        wrapped_key = _load_public_key(public_key).encrypt(content_key, _oaep_padding())
+        wrapped_keys.append(f'{recipient_id}.{_b64(wrapped_key)}')
+    
+    return ':'.join([MULTI_RECIPIENT_VERSION, ','.join(wrapped_keys), _b64(nonce), _b64(ciphertext)])
+
+def recipient_ciphertext(encrypted_message, recipient_id):
+    """
+    Reduce a multi-recipient envelope to the single-recipient 'v2' envelope
+    for recipient_id. Other formats, and envelopes without an entry for the
+    recipient, are returned unchanged.
+    """
+    if not encrypted_message.startswith(MULTI_RECIPIENT_VERSION + ':'):
+        return encrypted_message
+    
+    _, wrapped_keys, nonce, ciphertext = encrypted_message.split(':')
+    for entry in wrapped_keys.split(','):
+        entry_id, wrapped_key = entry.split('.', 1)
+        if entry_id == str(recipient_id):
+            return ':'.join([ENVELOPE_VERSION, wrapped_key, nonce, ciphertext])
+    return encrypted_message
+
+# Binary frame stored in Message.payload:
+#   byte 0        frame format (FRAME_LEGACY or FRAME_HYBRID)
+#   byte 1        number of wrapped-key entries
+#   per entry     uint64 recipient id, uint32 length, entry bytes
+#   hybrid only   12-byte nonce, then the AES-GCM ciphertext to the end
+# A legacy entry is a uint16 RSA block size followed by the raw RSA blocks.
+FRAME_LEGACY = 1
+FRAME_HYBRID = 2
+_FRAME_HEADER = struct.Struct('>BB')
+_FRAME_ENTRY = struct.Struct('>QI')
+_LEGACY_BLOCK_SIZE = struct.Struct('>H')
+
+def pack_frame(frame_format, wrapped_keys, nonce=b'', ciphertext=b''):
+    """
+    Serialise wrapped keys (a list of (recipient_id, bytes)) and the body into a binary frame
+    """
+    parts = [_FRAME_HEADER.pack(frame_format, len(wrapped_keys))]
+    for recipient_id, wrapped_key in wrapped_keys:
+        parts.append(_FRAME_ENTRY.pack(recipient_id, len(wrapped_key)))
+        parts.append(wrapped_key)
+    if frame_format == FRAME_HYBRID:
+        parts.append(nonce)
+        parts.append(ciphertext)
+    return b''.join(parts)
+
+def unpack_frame(data):
+    """
+    Parse a binary frame
+    Returns (frame_format, {recipient_id: entry_bytes}, nonce, ciphertext)
+    """
+    data = bytes(data)
+    frame_format, count = _FRAME_HEADER.unpack_from(data)
+    offset = _FRAME_HEADER.size
+    
+    wrapped_keys = {}
+    for _ in range(count):
+        recipient_id, length = _FRAME_ENTRY.unpack_from(data, offset)
+        offset += _FRAME_ENTRY.size
+        wrapped_keys[recipient_id] = data[offset:offset + length]
+        offset += length
+    
+    nonce = data[offset:offset + NONCE_SIZE]
+    ciphertext = data[offset + NONCE_SIZE:]
+    return frame_format, wrapped_keys, nonce, ciphertext
+
+def encrypt_message_frame(message, recipients):
+    """
+    Like encrypt_message_for_recipients, but returns the compact binary frame
+    """
+    content_key, nonce, ciphertext = _seal(message)
+    
+    wrapped_keys = [
+        (recipient_id, _load_public_key(public_key).encrypt(content_key, _oaep_padding()))
+        for recipient_id, public_key in recipients.items()
+    ]
+    return pack_frame(FRAME_HYBRID, wrapped_keys, nonce, ciphertext)
+
+def frame_ciphertext(data, recipient_id):
+    """
+    Return the text ciphertext a recipient decrypts (a 'v2' envelope or
+    legacy '|'-joined chunks), base64 encoded for the JSON API.
+    Returns None if the frame has no entry for the recipient.
+    """
+    frame_format, wrapped_keys, nonce, ciphertext = unpack_frame(data)
+    entry = wrapped_keys.get(recipient_id)
+    if entry is None:
+        return None
+    
+    if frame_format == FRAME_HYBRID:
+        return ':'.join([ENVELOPE_VERSION, _b64(entry), _b64(nonce), _b64(ciphertext)])
+    
+    (block_size,) = _LEGACY_BLOCK_SIZE.unpack_from(entry)
+    blocks = entry[_LEGACY_BLOCK_SIZE.size:]
+    return '|'.join(_b64(blocks[i:i + block_size]) for i in range(0, len(blocks), block_size))
+
+def frame_from_ciphertexts(ciphertexts):
+    """
+    Convert stored text ciphertexts into one binary frame
+    ciphertexts is a list of (recipient_id, text) pairs; for 'v3' text the
+    ids embedded in the envelope are used instead.
+
+    Returns None when the texts can't share a frame (e.g. two 'v2' envelopes
+    with different bodies), in which case the row should stay as text.
+    """
+    frame_format = None
+    wrapped_keys = []
+    body = None
+    
+    for recipient_id, encrypted_message in ciphertexts:
+        if is_legacy_ciphertext(encrypted_message):
+            blocks = [base64.b64decode(chunk) for chunk in encrypted_message.split('|')]
+            if frame_format not in (None, FRAME_LEGACY) or len({len(block) for block in blocks}) != 1:
+                return None
+            frame_format = FRAME_LEGACY
+            entry = _LEGACY_BLOCK_SIZE.pack(len(blocks[0])) + b''.join(blocks)
+            wrapped_keys.append((recipient_id, entry))
+            continue
+        
+        version, keys, nonce, ciphertext = encrypted_message.split(':')
+        if frame_format not in (None, FRAME_HYBRID) or body not in (None, (nonce, ciphertext)):
+            return None
+        frame_format = FRAME_HYBRID
+        body = (nonce, ciphertext)
+        
+        if version == MULTI_RECIPIENT_VERSION:
+            for entry in keys.split(','):
+                entry_id, wrapped_key = entry.split('.', 1)
+                wrapped_keys.append((int(entry_id), base64.b64decode(wrapped_key)))
+        else:
+            wrapped_keys.append((recipient_id, base64.b64decode(keys)))
+    
+    if frame_format is None:
+        return None
+    if frame_format == FRAME_LEGACY:
+        return pack_frame(FRAME_LEGACY, wrapped_keys)
+    return pack_frame(FRAME_HYBRID, wrapped_keys, base64.b64decode(body[0]), base64.b64decode(body[1]))
+
+def is_legacy_ciphertext(encrypted_message):
+    """
+    Return True if the ciphertext uses the chunked RSA format
     """
-    # Load the private key
-    private_key = serialization.load_pem_private_key(
+    return not encrypted_message.startswith((ENVELOPE_VERSION + ':', MULTI_RECIPIENT_VERSION + ':'))
+
+def load_private_key(private_key_pem):
+    """
+    Parse a PEM private key
+    """
+    return serialization.load_pem_private_key(
         private_key_pem.encode('utf-8'),
         password=None,
         backend=default_backend()
     )
+
+def decrypt_message(encrypted_message, private_key_pem):
+    """
+    Decrypt a message using the recipient's private key
+    Handles the hybrid 'v2'/'v3' envelopes and legacy '|'-joined RSA chunks
+    private_key_pem may also be a key already parsed with load_private_key
+    """
+    # Load the private key unless the caller passed a parsed one
+    if isinstance(private_key_pem, str):
+        private_key = load_private_key(private_key_pem)
+    else:
+        private_key = private_key_pem
+    
+    if not is_legacy_ciphertext(encrypted_message):
+        version, wrapped_keys, nonce, ciphertext = encrypted_message.split(':')
+        
+        # Unwrap the content key, then decrypt the body. For a multi-recipient
+        # envelope we don't know which entry is ours, so try each in turn.
+        if version == MULTI_RECIPIENT_VERSION:
+            candidates = [entry.split('.', 1)[1] for entry in wrapped_keys.split(',')]
+        else:
+            candidates = [wrapped_keys]
+        
+        content_key = None
+        for wrapped_key in candidates:
+            try:
+                content_key = private_key.decrypt(base64.b64decode(wrapped_key), _oaep_padding())
+                break
+            except ValueError:
+                continue
+        if content_key is None:
+            raise ValueError('No wrapped key in this message matches the private key')
+        
+        plaintext = AESGCM(content_key).decrypt(
+            base64.b64decode(nonce),
+            base64.b64decode(ciphertext),
+            None
+        )
+        return plaintext.decode('utf-8')
     
     # Split the message into chunks
     encrypted_chunks = encrypted_message.split('|')
@@ -86,15 +362,29 @@ def decrypt_message(encrypted_message, private_key_pem):
         encrypted_data = base64.b64decode(chunk)
         
         # Decrypt the chunk
-        decrypted = private_key.decrypt(
-            encrypted_data,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        decrypted = private_key.decrypt(encrypted_data, _oaep_padding())
         decrypted_chunks.append(decrypted)
     
     # Join decrypted chunks and convert to string
     return b''.join(decrypted_chunks).decode('utf-8')
+
+def decrypt_messages(encrypted_messages, private_key_pem, executor=None):
+    """
+    Decrypt a list of messages with one private key
+    The key is parsed once. When an executor is given the items are decrypted
+    concurrently; cryptography releases the GIL during RSA operations.
+
+    Returns a list in the same order holding either the plaintext or the
+    exception raised for that item.
+    """
+    private_key = load_private_key(private_key_pem)
+    
+    def decrypt_one(encrypted_message):
+        try:
+            return decrypt_message(encrypted_message, private_key)
+        except Exception as e:
+            return e
+    
+    if executor is None:
+        return [decrypt_one(encrypted_message) for encrypted_message in encrypted_messages]
+    return list(executor.map(decrypt_one, encrypted_messages))
@@ -0,0 +1,16 @@
+"""
+Shared executors for CPU-bound crypto work.
+
+RSA operations in the cryptography library release the GIL, so a small
+thread pool gives real parallelism without tying up the request thread or
+the thread that channels uses for ORM calls.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+crypto_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'CRYPTO_EXECUTOR_WORKERS', 4),
+    thread_name_prefix='crypto'
+)
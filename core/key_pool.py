@@ -0,0 +1,134 @@
+"""
+Pool of pre-generated RSA key pairs for registration.
+
+Generating a 2048-bit RSA key takes tens to hundreds of milliseconds of CPU,
+which is too long to spend on the request thread during sign-up bursts. The
+pool keeps a few key pairs ready and refills itself in a background process
+pool once it drops to the low watermark. When it is empty, take() falls back
+to generating a key pair inline.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import threading
+import time
+
+from django.conf import settings
+
+from .encryption import generate_key_pair
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class KeyPairPool:
+    def __init__(self, low_watermark=2, high_watermark=8, workers=1):
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.workers = workers
+        self._pairs = deque()
+        self._pending = 0
+        self._generated_at = deque()
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def take(self):
+        """
+        Return a (public_key_pem, private_key_pem) pair
+        Uses a pooled pair when one is ready, otherwise generates inline.
+        """
+        with self._lock:
+            pair = self._pairs.popleft() if self._pairs else None
+        
+        if pair is None:
+            metrics.incr('key_pool.inline_generations')
+            pair = generate_key_pair()
+        else:
+            metrics.incr('key_pool.hits')
+        
+        self.warm()
+        return pair
+    
+    def warm(self):
+        """
+        Start background generation if the pool is at or below the low watermark
+        """
+        with self._lock:
+            if len(self._pairs) + self._pending > self.low_watermark:
+                return
+            needed = self.high_watermark - len(self._pairs) - self._pending
+            self._pending += needed
+            if self._executor is None:
+                # spawn, not fork: the server process has threads and open sockets
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            executor = self._executor
+        
+        for submitted in range(needed):
+            try:
+                executor.submit(generate_key_pair).add_done_callback(self._on_generated)
+            except BrokenProcessPool:
+                # Never let background generation break registration; take()
+                # generates inline and the next warm() starts a fresh pool
+                logger.exception('Key pair pool executor is broken, restarting it')
+                self._discard_executor(executor, needed - submitted)
+                return
+    
+    def _discard_executor(self, executor, unsubmitted=0):
+        with self._lock:
+            self._pending -= unsubmitted
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _on_generated(self, future):
+        with self._lock:
+            self._pending -= 1
+        
+        try:
+            pair = future.result()
+        except BrokenProcessPool:
+            logger.exception('Key pair pool worker died')
+            with self._lock:
+                self._executor = None
+            return
+        except Exception:
+            logger.exception('Background key pair generation failed')
+            return
+        
+        with self._lock:
+            self._pairs.append(pair)
+            self._generated_at.append(time.monotonic())
+    
+    def depth(self):
+        """Number of key pairs ready to hand out"""
+        with self._lock:
+            return len(self._pairs)
+    
+    def refill_rate(self, window=60.0):
+        """Key pairs generated per second over the last window seconds"""
+        cutoff = time.monotonic() - window
+        with self._lock:
+            while self._generated_at and self._generated_at[0] < cutoff:
+                self._generated_at.popleft()
+            return len(self._generated_at) / window
+
+
+def _pool_from_settings():
+    config = getattr(settings, 'KEY_POOL', {})
+    return KeyPairPool(
+        low_watermark=config.get('LOW_WATERMARK', 2),
+        high_watermark=config.get('HIGH_WATERMARK', 8),
+        workers=config.get('WORKERS', 1),
+    )
+
+
+key_pool = _pool_from_settings()
+
+metrics.gauge('key_pool.depth', key_pool.depth)
+metrics.gauge('key_pool.refill_rate', key_pool.refill_rate)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.backfill import backfill_message_payloads
+from core.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Convert text message ciphertexts into compact binary payloads, in resumable batches'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows converted per transaction (default: 500)')
+    
+    def handle(self, *args, **options):
+        converted, skipped = backfill_message_payloads(
+            Message,
+            batch_size=options['batch_size'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Converted {converted} messages; {skipped} could not be framed and were left as text'
+        ))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core.benchmarks import chat_pipeline
+
+
+class Command(BaseCommand):
+    help = 'Compare concurrent-sender latency with encryption inline on the DB thread vs on the crypto executor'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--senders', type=int, default=20, help='Concurrent senders (default: 20)')
+        parser.add_argument('--messages', type=int, default=50, help='Messages per sender (default: 50)')
+        parser.add_argument('--size', type=int, default=2000, help='Message size in bytes (default: 2000)')
+        parser.add_argument('--query-ms', type=float, default=0.2,
+                            help='Simulated duration of each ORM call in ms (default: 0.2)')
+    
+    def handle(self, *args, **options):
+        results = chat_pipeline.run(
+            senders=options['senders'],
+            messages=options['messages'],
+            size=options['size'],
+            query_ms=options['query_ms'],
+        )
+        
+        self.stdout.write(f"{'mode':<10}{'msgs/s':>10}{'send p50':>11}{'send p99':>11}{'probe p50':>11}{'probe p99':>11}")
+        for result in results:
+            self.stdout.write(
+                f"{result['mode']:<10}{result['throughput']:>10.0f}"
+                f"{result['send_p50_ms']:>9.2f}ms{result['send_p99_ms']:>9.2f}ms"
+                f"{result['probe_p50_ms']:>9.2f}ms{result['probe_p99_ms']:>9.2f}ms"
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.benchmarks import ratchet
+
+
+class Command(BaseCommand):
+    help = 'Measure ratchet decryption key lookup at increasing chain depths'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--depths', default='10000,100000,1000000',
+                            help='Comma-separated messages per session (default: 10000,100000,1000000)')
+    
+    def handle(self, *args, **options):
+        depths = [int(depth) for depth in options['depths'].split(',')]
+        
+        self.stdout.write(
+            f"{'depth':>9}{'linear':>12}{'linear replay':>15}{'replay':>10}"
+            f"{'per msg':>10}{'random p50':>12}{'random p99':>12}{'decrypt':>10}"
+        )
+        for result in ratchet.run(depths):
+            self.stdout.write(
+                f"{result['depth']:>9}{result['linear_ms']:>10.1f}ms"
+                f"{result['linear_replay_estimate_s']:>13.0f}s*{result['replay_s']:>9.2f}s"
+                f"{result['replay_per_message_us']:>8.1f}us{result['random_p50_us']:>10.1f}us"
+                f"{result['random_p99_us']:>10.1f}us{result['decrypt_us']:>8.0f}us"
+            )
+        self.stdout.write('* estimated from the single linear walk')
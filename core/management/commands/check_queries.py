@@ -0,0 +1,164 @@
+import re
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from core.encryption import encrypt_message_frame, generate_key_pair
+from core.models import Contact, Message, MessageKey, UserProfile
+from core.utils import conversation_contact, conversation_page, get_contacts_with_unread_count
+
+# Plan steps that mean a query reads a whole table or sorts outside an index
+BAD_PLAN_STEP = re.compile(r'^SCAN (?!CONSTANT ROW)|USE TEMP B-TREE')
+
+
+class Command(BaseCommand):
+    help = ('Check that the conversation endpoints run the same number of queries however long '
+            'the conversation is, and (on SQLite) that none of them scans a table or sorts '
+            'outside an index (uses a throwaway test database)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000',
+                            help='Comma-separated conversation lengths to measure (default: 10,100,1000)')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            counts = self.measure(sizes)
+            plan_failures = self.check_plans() if connection.vendor == 'sqlite' else None
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        failures = []
+        self.stdout.write(f"{'endpoint':<20}" + ''.join(f'{size:>8}' for size in sizes))
+        for endpoint, by_size in counts.items():
+            self.stdout.write(f'{endpoint:<20}' + ''.join(f'{by_size[size]:>8}' for size in sizes))
+            if len(set(by_size.values())) > 1:
+                failures.append(endpoint)
+
+        if plan_failures is None:
+            self.stdout.write('Query plans are only checked on SQLite')
+        elif plan_failures:
+            self.stdout.write('\n'.join(plan_failures))
+            failures.append('query plans')
+        
+        if failures:
+            raise CommandError(f"Failed checks: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS('Query counts are constant and query plans use indexes'))
+
+    def make_user(self, username):
+        user = User.objects.create_user(username, password=None)
+        UserProfile.objects.create(user=user, calculator_password='0000')
+        public_key, _ = generate_key_pair()
+        MessageKey.objects.create(user=user, public_key=public_key)
+        return user
+
+    def measure(self, sizes):
+        """
+        Grow one conversation to each size (half the messages in each
+        direction, so every request also moves the read watermark) and
+        count the queries each endpoint runs
+        """
+        user = self.user = self.make_user('query_check_user')
+        contact = self.contact = self.make_user('query_check_contact')
+        Contact.objects.create(owner=user, contact_user=contact)
+        Contact.objects.create(owner=contact, contact_user=user)
+        payload = encrypt_message_frame('query check', {
+            user.id: MessageKey.objects.get(user=user).load_public_key(),
+            contact.id: MessageKey.objects.get(user=contact).load_public_key(),
+        })
+
+        client = Client()
+        client.force_login(user)
+        session = client.session
+        session['calculator_verified'] = True
+        session.save()
+
+        endpoints = {
+            'get_messages': reverse('get_messages', args=[contact.id]),
+            'messages_view': reverse('messages_view') + f'?contact={contact.id}',
+        }
+
+        # Warm up so one-off work (creating the watermark row) isn't counted
+        Message.objects.create(sender=contact, receiver=user, payload=payload)
+        for url in endpoints.values():
+            client.get(url)
+
+        # bulk_create skips Message.save(), which would fill this in
+        conversation_key = Message.conversation_key_for(user.id, contact.id)
+        counts = {endpoint: {} for endpoint in endpoints}
+        # Queries each endpoint ran on its last (largest) request, for check_plans
+        self.captured = {}
+        for size in sizes:
+            Message.objects.bulk_create([
+                Message(sender=user if i % 2 else contact, receiver=contact if i % 2 else user, payload=payload,
+                        conversation_key=conversation_key)
+                for i in range(size - Message.objects.count())
+            ])
+            for endpoint, url in endpoints.items():
+                # A new incoming message so the request has something to mark read
+                Message.objects.create(sender=contact, receiver=user, payload=payload)
+                with CaptureQueriesContext(connection) as queries:
+                    response = client.get(url)
+                if response.status_code != 200:
+                    raise CommandError(f'{endpoint} returned {response.status_code}')
+                counts[endpoint][size] = len(queries)
+                self.captured[endpoint] = queries.captured_queries
+            
+            # A polling client that is up to date: should be a 304 from one lookup
+            idle_url = endpoints['get_messages'] + f"?after={Message.objects.latest('id').id}&read_up_to=0"
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(idle_url)
+            if response.status_code != 304:
+                raise CommandError(f'Idle poll returned {response.status_code}, expected 304')
+            counts.setdefault('get_messages (idle)', {})[size] = len(queries)
+            self.captured['get_messages (idle)'] = queries.captured_queries
+        return counts
+    
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+    
+    def check_plans(self):
+        """
+        EXPLAIN every query the endpoints ran at the largest size, plus the
+        hot conversation queries, each of which must use its own index
+        Returns a description of each failure.
+        """
+        failures = []
+        for endpoint, queries in self.captured.items():
+            for query in queries:
+                if not query['sql'].startswith('SELECT'):
+                    continue
+                bad_steps = [step for step in self.explain(query['sql']) if BAD_PLAN_STEP.search(step)]
+                if bad_steps:
+                    failures.append(f"{endpoint}: {'; '.join(bad_steps)}\n    {query['sql']}")
+        
+        message_id = Message.objects.filter(receiver=self.user).latest('id').id
+        hot_queries = {
+            'newest page': (lambda: conversation_page(self.user, self.contact), 'core_msg_conversation_idx'),
+            'older page': (lambda: conversation_page(self.user, self.contact, before=message_id),
+                           'core_msg_conversation_idx'),
+            'newer page': (lambda: conversation_page(self.user, self.contact, after=message_id),
+                           'core_msg_conversation_idx'),
+            'conversation state': (lambda: conversation_contact(self.user, self.contact.id),
+                                   'core_msg_conversation_idx'),
+            'unread counts': (lambda: list(get_contacts_with_unread_count(self.user)), 'core_msg_unread_idx'),
+        }
+        for name, (run, index) in hot_queries.items():
+            with CaptureQueriesContext(connection) as queries:
+                run()
+            plan = [step for query in queries.captured_queries for step in self.explain(query['sql'])]
+            if not any(index in step for step in plan):
+                failures.append(f"{name} doesn't use {index}: {'; '.join(plan)}")
+            failures.extend(f'{name}: {step}' for step in plan if BAD_PLAN_STEP.search(step))
+        return failures
@@ -0,0 +1,55 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarks import crypto
+
+
+class Command(BaseCommand):
+    help = 'Run the crypto micro-benchmarks, write JSON results and optionally compare them with a baseline'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Write the JSON results to this file (default: print them)')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+        parser.add_argument('--threshold', type=float, default=0.10,
+                            help='Allowed slowdown of a median before it counts as a regression (default: 0.10 = 10%%)')
+        parser.add_argument('--statistic', choices=['median', 'min'], default='median',
+                            help='Statistic compared against the baseline (default: median; min is steadier on noisy machines)')
+        parser.add_argument('--only', help='Only run cases whose name contains this text')
+        parser.add_argument('--quick', action='store_true', help='Take fewer samples')
+    
+    def handle(self, *args, **options):
+        results = crypto.run(only=options['only'], quick=options['quick'])
+        
+        self.stderr.write(f"{'case':<45}{'median':>12}{'p99':>12}")
+        for name, stats in results['results'].items():
+            self.stderr.write(f"{name:<45}{stats['median_us']:>10.1f}us{stats['p99_us']:>10.1f}us")
+        
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+        
+        if not options['baseline']:
+            return
+        
+        try:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read baseline {options['baseline']}: {e}")
+        
+        rows, regressions = crypto.compare(results, baseline, options['threshold'], options['statistic'] + '_us')
+        self.stderr.write(f"\n{'case':<45}{'baseline':>12}{'current':>12}{'change':>9}")
+        for name, before, after, change in rows:
+            marker = ' !' if name in regressions else ''
+            self.stderr.write(f"{name:<45}{before:>10.1f}us{after:>10.1f}us{change:>+8.0%}{marker}")
+        
+        if regressions:
+            raise CommandError(
+                f"{len(regressions)} case(s) slower than the baseline by more than {options['threshold']:.0%} "
+                f"({options['statistic']}): "
+                + ', '.join(regressions)
+            )
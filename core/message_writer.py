@@ -0,0 +1,123 @@
+"""
+Group-commit writer for messages sent over WebSockets.
+
+Saving each message with its own INSERT makes every sender pay for a
+separate transaction (and, on SQLite, a separate fsync). Consumers instead
+hand their rows to the writer, which gathers everything queued in the process
+for up to FLUSH_WINDOW seconds (or until MAX_BATCH rows are waiting), writes
+the batch with one bulk_create inside one transaction, and resolves each
+sender's future with the id and timestamp of its row.
+
+Queues belong to an event loop, so the writer keeps one queue and flush task
+per loop (normally there is just uvicorn's).
+"""
+
+import asyncio
+import logging
+import time
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingMessage:
+    def __init__(self, fields, future):
+        self.fields = fields
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class _LoopState:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        # Set when a full batch is waiting, so the flush window can end early
+        self.batch_ready = asyncio.Event()
+        self.task = None
+
+
+class MessageWriter:
+    def __init__(self, flush_window=0.005, max_batch=100):
+        self.flush_window = flush_window
+        self.max_batch = max_batch
+        self._states = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            state = self._states[loop] = _LoopState()
+        if state.task is None or state.task.done():
+            state.task = loop.create_task(self._run(state))
+        return state
+
+    async def write(self, **fields):
+        """
+        Queue a Message row and wait until its batch is committed
+        Returns (message_id, sent_on).
+        """
+        fields.setdefault('sent_on', timezone.now())
+        state = self._state()
+        future = asyncio.get_running_loop().create_future()
+        state.queue.put_nowait(_PendingMessage(fields, future))
+        if state.queue.qsize() >= self.max_batch:
+            state.batch_ready.set()
+        # The row is written even if the sender stops waiting
+        return await asyncio.shield(future)
+
+    async def _run(self, state):
+        while True:
+            batch = [await state.queue.get()]
+            if self.flush_window and state.queue.qsize() + 1 < self.max_batch:
+                try:
+                    await asyncio.wait_for(state.batch_ready.wait(), self.flush_window)
+                except asyncio.TimeoutError:
+                    pass
+            state.batch_ready.clear()
+            while len(batch) < self.max_batch and not state.queue.empty():
+                batch.append(state.queue.get_nowait())
+
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                logger.exception("Message batch write failed")
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        for pending in batch:
+            metrics.observe('message_writer.queue_latency_ms', (started - pending.queued_at) * 1000)
+        metrics.observe('message_writer.batch_size', len(batch))
+
+        messages = await database_sync_to_async(self._insert)([pending.fields for pending in batch])
+
+        metrics.observe('message_writer.write_ms', (time.perf_counter() - started) * 1000)
+        metrics.incr('message_writer.messages', len(batch))
+        for pending, message in zip(batch, messages):
+            if not pending.future.done():
+                pending.future.set_result((message.id, message.sent_on))
+
+    def _insert(self, rows):
+        # One transaction for the whole batch, whatever bulk_create splits it into
+        with transaction.atomic():
+            return Message.objects.bulk_create([
+                Message(conversation_key=Message.conversation_key_for(fields['sender_id'], fields['receiver_id']),
+                        **fields)
+                for fields in rows
+            ])
+
+
+_writer_settings = getattr(settings, 'MESSAGE_WRITER', {})
+message_writer = MessageWriter(
+    flush_window=_writer_settings.get('FLUSH_WINDOW', 0.005),
+    max_batch=_writer_settings.get('MAX_BATCH', 100),
+)
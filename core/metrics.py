@@ -0,0 +1,69 @@
+"""
+In-process metrics registry.
+
+Services publish counters, gauges and latency/size observations here, and
+the staff-only /api/metrics/ endpoint returns a snapshot as JSON. Values are
+per process; with several workers each one reports its own numbers.
+"""
+
+from collections import deque
+import threading
+
+
+class MetricsRegistry:
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._observations = {}
+    
+    def incr(self, name, value=1):
+        """Increase a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+    
+    def gauge(self, name, func):
+        """Register a callable that returns the current value of a gauge"""
+        with self._lock:
+            self._gauges[name] = func
+    
+    def observe(self, name, value):
+        """Record one observation (e.g. a latency or batch size)"""
+        with self._lock:
+            values = self._observations.get(name)
+            if values is None:
+                values = self._observations[name] = deque(maxlen=self.window)
+            values.append(value)
+    
+    def snapshot(self):
+        """
+        Return all metrics as a JSON-serialisable dict
+        Observations are summarised over the most recent window.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            observations = {name: sorted(values) for name, values in self._observations.items()}
+        
+        summaries = {}
+        for name, values in observations.items():
+            if not values:
+                continue
+            summaries[name] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': values[len(values) // 2],
+                'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+                'max': values[-1],
+            }
+        
+        return {
+            'counters': counters,
+            'gauges': {name: func() for name, func in gauges.items()},
+            'observations': summaries,
+        }
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:47
+
+from django.db import migrations, models
+
+
+def merge_self_copies(apps, schema_editor):
+    """
+    Fold the old "sent to self" rows into the message they copy.
+
+    A self copy was written right after the original with sender and receiver
+    swapped, is_read=True and the exact same sent_on. Its content moves into
+    the original's sender_copy and the row is deleted.
+    """
+    Message = apps.get_model('core', 'Message')
+    
+    originals = {}
+    merged_ids = []
+    rows = Message.objects.order_by('id').values_list('id', 'sender_id', 'receiver_id', 'sent_on', 'is_read', 'content')
+    for message_id, sender_id, receiver_id, sent_on, is_read, content in rows.iterator():
+        original_id = originals.pop((receiver_id, sender_id, sent_on), None) if is_read else None
+        if original_id is not None:
+            Message.objects.filter(id=original_id).update(sender_copy=content)
+            merged_ids.append(message_id)
+        else:
+            originals[(sender_id, receiver_id, sent_on)] = message_id
+    
+    for i in range(0, len(merged_ids), 500):
+        Message.objects.filter(id__in=merged_ids[i:i + 500]).delete()
+
+
+def split_self_copies(apps, schema_editor):
+    Message = apps.get_model('core', 'Message')
+    
+    copies = []
+    for message in Message.objects.exclude(sender_copy=None).iterator():
+        copies.append(Message(
+            sender_id=message.receiver_id,
+            receiver_id=message.sender_id,
+            content=message.sender_copy,
+            is_read=True,
+            sent_on=message.sent_on,
+        ))
+    Message.objects.bulk_create(copies, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_remove_messagekey_private_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='sender_copy',
+            field=models.TextField(blank=True, help_text="Legacy copy of the content encrypted to the sender's own key", null=True),
+        ),
+        migrations.RunPython(merge_self_copies, split_self_copies),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_message_sender_copy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='payload',
+            field=models.BinaryField(blank=True, help_text='Encrypted message content as a binary frame (see core.encryption.pack_frame)', null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.TextField(blank=True, default='', help_text='Encrypted message content (text format, for rows not yet backfilled)'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    from core.backfill import backfill_message_payloads
+    backfill_message_payloads(apps.get_model('core', 'Message'))
+
+
+def restore(apps, schema_editor):
+    from core.backfill import restore_message_text
+    restore_message_text(apps.get_model('core', 'Message'))
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own instead of holding one long transaction;
+    # an interrupted run is finished by `manage.py backfill_message_payloads`.
+    atomic = False
+
+    dependencies = [
+        ('core', '0005_message_payload'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, restore),
+    ]
@@ -0,0 +1,87 @@
+from django.db import migrations, models
+
+
+PREKEY_MODELS = ('SignedPreKey', 'OneTimePreKey')
+
+
+def pem_to_raw(apps, schema_editor):
+    from core.signal_protocol import public_key_pem_to_raw, private_key_pem_to_raw
+    for model_name in PREKEY_MODELS:
+        model = apps.get_model('core', model_name)
+        for prekey in model.objects.iterator():
+            prekey.public_key_raw = public_key_pem_to_raw(prekey.public_key)
+            prekey.private_key_raw = private_key_pem_to_raw(prekey.private_key)
+            prekey.save(update_fields=['public_key_raw', 'private_key_raw'])
+
+
+def raw_to_pem(apps, schema_editor):
+    from core.signal_protocol import public_key_raw_to_pem, private_key_raw_to_pem
+    for model_name in PREKEY_MODELS:
+        model = apps.get_model('core', model_name)
+        for prekey in model.objects.iterator():
+            prekey.public_key = public_key_raw_to_pem(prekey.public_key_raw)
+            prekey.private_key = private_key_raw_to_pem(prekey.private_key_raw)
+            prekey.save(update_fields=['public_key', 'private_key'])
+
+
+def raw_key_operations(model_name):
+    """
+    Add raw key columns next to the PEM ones; the PEM columns get a default
+    so that reversing the RemoveField below works on a populated table.
+    """
+    return [
+        migrations.AddField(
+            model_name=model_name,
+            name='public_key_raw',
+            field=models.BinaryField(max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name=model_name,
+            name='private_key_raw',
+            field=models.BinaryField(max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name=model_name,
+            name='public_key',
+            field=models.TextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name=model_name,
+            name='private_key',
+            field=models.TextField(default=''),
+        ),
+    ]
+
+
+def swap_operations(model_name):
+    return [
+        migrations.RemoveField(model_name=model_name, name='public_key'),
+        migrations.RemoveField(model_name=model_name, name='private_key'),
+        migrations.RenameField(model_name=model_name, old_name='public_key_raw', new_name='public_key'),
+        migrations.RenameField(model_name=model_name, old_name='private_key_raw', new_name='private_key'),
+        migrations.AlterField(
+            model_name=model_name,
+            name='public_key',
+            field=models.BinaryField(max_length=32, help_text='Raw 32-byte X25519 public key'),
+        ),
+        migrations.AlterField(
+            model_name=model_name,
+            name='private_key',
+            field=models.BinaryField(max_length=32, help_text='Raw 32-byte X25519 private key'),
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_backfill_message_payload'),
+    ]
+
+    operations = (
+        raw_key_operations('signedprekey')
+        + raw_key_operations('onetimeprekey')
+        + [migrations.RunPython(pem_to_raw, raw_to_pem)]
+        + swap_operations('signedprekey')
+        + swap_operations('onetimeprekey')
+    )
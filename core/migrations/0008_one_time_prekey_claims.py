@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_prekey_raw_keys'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='onetimeprekey',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='onetimeprekey',
+            name='claimed_by',
+            field=models.ForeignKey(blank=True, help_text='User whose session setup consumed this key', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='claimed_prekeys', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='onetimeprekey',
+            index=models.Index(fields=['user', 'is_used', 'key_id'], name='core_otk_unused_idx'),
+        ),
+    ]
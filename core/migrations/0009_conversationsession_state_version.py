@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_one_time_prekey_claims'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsession',
+            name='state_version',
+            field=models.PositiveIntegerField(default=0, help_text='Bumped on every ratchet state write (compare-and-swap, see core.session_cache)'),
+        ),
+    ]
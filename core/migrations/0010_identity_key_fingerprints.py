@@ -0,0 +1,54 @@
+from django.db import migrations, models
+
+
+def fill_fingerprints(apps, schema_editor):
+    """
+    Store key fingerprints and re-derive existing security codes from them
+    (the keys didn't change, so verification status is kept)
+    """
+    from core.signal_protocol import identity_key_fingerprint, security_code_from_fingerprints
+    MessageKey = apps.get_model('core', 'MessageKey')
+    UserProfile = apps.get_model('core', 'UserProfile')
+    Contact = apps.get_model('core', 'Contact')
+    
+    fingerprints = {}
+    for key in MessageKey.objects.iterator():
+        key.fingerprint = identity_key_fingerprint(key.public_key)
+        key.save(update_fields=['fingerprint'])
+        fingerprints[key.user_id] = key.fingerprint
+        UserProfile.objects.filter(user_id=key.user_id).update(identity_key_fingerprint=key.fingerprint)
+    
+    for contact in Contact.objects.exclude(security_code=None).exclude(security_code='').iterator():
+        owner_fingerprint = fingerprints.get(contact.owner_id)
+        contact_fingerprint = fingerprints.get(contact.contact_user_id)
+        if owner_fingerprint and contact_fingerprint:
+            contact.security_code = security_code_from_fingerprints(owner_fingerprint, contact_fingerprint)
+        else:
+            contact.security_code = None
+        contact.save(update_fields=['security_code'])
+
+
+def clear_security_codes(apps, schema_editor):
+    # Codes are derived again from the keys on the next verification view
+    apps.get_model('core', 'Contact').objects.update(security_code=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_conversationsession_state_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagekey',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', help_text='SHA-256 of the public key, kept in sync on save', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='contact',
+            name='security_code',
+            field=models.CharField(blank=True, help_text="Security verification code like WhatsApp's security code", max_length=72, null=True),
+        ),
+        migrations.RunPython(fill_fingerprints, clear_security_codes),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_watermarks(apps, schema_editor):
+    """
+    Start each conversation's watermark at its newest message marked read
+    """
+    Message = apps.get_model('core', 'Message')
+    ReadWatermark = apps.get_model('core', 'ReadWatermark')
+    read = Message.objects.filter(is_read=True).values('receiver_id', 'sender_id').annotate(last_read=Max('id'))
+    ReadWatermark.objects.bulk_create(
+        [ReadWatermark(reader_id=row['receiver_id'], peer_id=row['sender_id'], last_read_message_id=row['last_read'])
+         for row in read.iterator()],
+        batch_size=500
+    )
+
+
+def restore_is_read(apps, schema_editor):
+    Message = apps.get_model('core', 'Message')
+    ReadWatermark = apps.get_model('core', 'ReadWatermark')
+    for watermark in ReadWatermark.objects.iterator():
+        Message.objects.filter(
+            receiver_id=watermark.reader_id, sender_id=watermark.peer_id, id__lte=watermark.last_read_message_id
+        ).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_identity_key_fingerprints'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('peer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('reader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_watermarks', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('reader', 'peer')},
+            },
+        ),
+        migrations.RunPython(seed_watermarks, restore_is_read),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_conversation_keys(apps, schema_editor):
+    """
+    One UPDATE per direction of each conversation
+    """
+    Message = apps.get_model('core', 'Message')
+    pairs = Message.objects.filter(conversation_key='').values_list('sender_id', 'receiver_id').distinct()
+    for sender_id, receiver_id in list(pairs):
+        low, high = sorted([sender_id, receiver_id])
+        Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id).update(
+            conversation_key=f'{low}:{high}'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_read_watermarks'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, help_text="Both participants' ids, lower first (see conversation_key_for)", max_length=41),
+        ),
+        migrations.RunPython(fill_conversation_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'id'], name='core_msg_conversation_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_message_conversation_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'id'], name='core_msg_unread_idx'),
+        ),
+    ]
@@ -1,10 +1,13 @@
-from django.db import models
+from django.db import models, IntegrityError, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 import secrets
 import string
 import base64
 
+from .encryption import public_key_cache, recipient_ciphertext, frame_ciphertext
+from .signal_protocol import identity_key_fingerprint, security_code_from_fingerprints
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     calculator_password = models.CharField(max_length=255, help_text="Password to access messaging from calculator")
@@ -21,11 +24,32 @@ class MessageKey(models.Model):
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='message_key')
     public_key = models.TextField()
+    fingerprint = models.CharField(max_length=64, blank=True, default='',
+                                   help_text="SHA-256 of the public key, kept in sync on save")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return f"{self.user.username}'s Public Identity Key"
+    
+    def save(self, *args, **kwargs):
+        """
+        Recompute the fingerprint; fingerprint_changed tells the post_save
+        handler (core.signals) whether security codes must be invalidated
+        """
+        fingerprint = identity_key_fingerprint(self.public_key)
+        self.fingerprint_changed = fingerprint != self.fingerprint
+        self.fingerprint = fingerprint
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'public_key' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'fingerprint'}
+        super().save(*args, **kwargs)
+    
+    def load_public_key(self):
+        """
+        Return the parsed public key object, cached until the key is rotated
+        """
+        return public_key_cache.get((self.pk, self.updated_at), self.public_key)
 
 class SignedPreKey(models.Model):
     """
@@ -34,8 +58,8 @@ class SignedPreKey(models.Model):
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='signed_prekeys')
     key_id = models.PositiveIntegerField(help_text="Identifier for this pre-key")
-    public_key = models.TextField()
-    private_key = models.TextField()
+    public_key = models.BinaryField(max_length=32, help_text="Raw 32-byte X25519 public key")
+    private_key = models.BinaryField(max_length=32, help_text="Raw 32-byte X25519 private key")
     signature = models.TextField(help_text="Signature from identity key")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -53,13 +77,20 @@ class OneTimePreKey(models.Model):
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='one_time_prekeys')
     key_id = models.PositiveIntegerField(help_text="Identifier for this one-time pre-key")
-    public_key = models.TextField()
-    private_key = models.TextField()
+    public_key = models.BinaryField(max_length=32, help_text="Raw 32-byte X25519 public key")
+    private_key = models.BinaryField(max_length=32, help_text="Raw 32-byte X25519 private key")
     is_used = models.BooleanField(default=False)
+    claimed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='claimed_prekeys', help_text="User whose session setup consumed this key")
+    claimed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         unique_together = ['user', 'key_id']
+        indexes = [
+            # Finding the next unused key for a user (see core.prekeys.claim_one_time_prekey)
+            models.Index(fields=['user', 'is_used', 'key_id'], name='core_otk_unused_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username}'s One-Time Pre-Key {self.key_id}"
@@ -76,6 +107,8 @@ class ConversationSession(models.Model):
     chain_key = models.TextField(help_text="The current chain key for message encryption")
     next_sending_key = models.TextField(help_text="Key for the next message to be sent")
     message_number = models.PositiveIntegerField(default=0, help_text="Number of messages in this session")
+    state_version = models.PositiveIntegerField(default=0,
+                                                help_text="Bumped on every ratchet state write (compare-and-swap, see core.session_cache)")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -96,7 +129,7 @@ class Contact(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacts')
     contact_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacted_by')
     added_on = models.DateTimeField(auto_now_add=True)
-    security_code = models.CharField(max_length=64, blank=True, null=True, 
+    security_code = models.CharField(max_length=72, blank=True, null=True, 
                                    help_text="Security verification code like WhatsApp's security code")
     security_verified = models.BooleanField(default=False, 
                                           help_text="Whether the security code has been verified by the user")
@@ -107,6 +140,17 @@ class Contact(models.Model):
     def __str__(self):
         return f"{self.owner.username} -> {self.contact_user.username}"
     
+    def ensure_security_code(self, owner_key, contact_key):
+        """
+        Return the pairwise security code, deriving it from the two stored key
+        fingerprints if it hasn't been computed yet or was invalidated by a
+        key change
+        """
+        if not self.security_code:
+            self.security_code = security_code_from_fingerprints(owner_key.fingerprint, contact_key.fingerprint)
+            self.save(update_fields=['security_code'])
+        return self.security_code
+    
     def generate_security_code(self):
         """Generate a security verification code similar to WhatsApp's 60-digit code"""
         # Create a code similar to WhatsApp's 60-digit verification code
@@ -119,9 +163,15 @@ class Contact(models.Model):
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
-    content = models.TextField(help_text="Encrypted message content")
+    conversation_key = models.CharField(max_length=41, default='', editable=False,
+                                        help_text="Both participants' ids, lower first (see conversation_key_for)")
+    content = models.TextField(blank=True, default='',
+                               help_text="Encrypted message content (text format, for rows not yet backfilled)")
+    payload = models.BinaryField(blank=True, null=True,
+                                 help_text="Encrypted message content as a binary frame (see core.encryption.pack_frame)")
+    sender_copy = models.TextField(blank=True, null=True,
+                                 help_text="Legacy copy of the content encrypted to the sender's own key")
     sent_on = models.DateTimeField(default=timezone.now)
-    is_read = models.BooleanField(default=False)
     session = models.ForeignKey(ConversationSession, on_delete=models.SET_NULL, null=True, 
                               related_name='messages', help_text="The session used for encryption")
     message_number = models.PositiveIntegerField(default=0, help_text="Position in the session for key verification")
@@ -130,6 +180,90 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['-sent_on']
+        indexes = [
+            # Pages of a conversation are ranges of this index (see core.utils.conversation_page)
+            models.Index(fields=['conversation_key', 'id'], name='core_msg_conversation_idx'),
+            # Unread counts: messages from a contact to the user above the read watermark
+            models.Index(fields=['sender', 'receiver', 'id'], name='core_msg_unread_idx'),
+        ]
         
     def __str__(self):
         return f"Message from {self.sender.username} to {self.receiver.username} at {self.sent_on}"
+    
+    @staticmethod
+    def conversation_key_for(user_id, other_user_id):
+        """
+        The same key for both directions of a conversation
+        """
+        low, high = sorted([int(user_id), int(other_user_id)])
+        return f'{low}:{high}'
+    
+    def save(self, *args, **kwargs):
+        # bulk_create skips save(); callers set conversation_key themselves there
+        if not self.conversation_key:
+            self.conversation_key = Message.conversation_key_for(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+    
+    # Columns row_ciphertext needs, for queries that fetch rows with values()
+    CIPHERTEXT_FIELDS = ('sender_id', 'payload', 'sender_copy', 'content')
+    
+    def ciphertext_for(self, user):
+        """
+        Return the ciphertext that this user can decrypt with their private key
+        New messages carry one wrapped key per participant in a binary payload;
+        older text rows kept a separate copy for the sender in sender_copy.
+        """
+        return Message.row_ciphertext({field: getattr(self, field) for field in Message.CIPHERTEXT_FIELDS}, user.id)
+    
+    @staticmethod
+    def row_ciphertext(row, user_id):
+        """
+        ciphertext_for on a values() row holding CIPHERTEXT_FIELDS
+        """
+        if row['payload'] is not None:
+            ciphertext = frame_ciphertext(row['payload'], user_id)
+            if ciphertext is not None:
+                return ciphertext
+        if row['sender_id'] == user_id and row['sender_copy']:
+            return row['sender_copy']
+        return recipient_ciphertext(row['content'], user_id)
+
+class ReadWatermark(models.Model):
+    """
+    How far a reader has read their conversation with a peer
+    Every message from peer to reader with id <= last_read_message_id is
+    read, so reading a backlog is one write however long it is.
+    """
+    reader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_watermarks')
+    peer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['reader', 'peer']
+    
+    def __str__(self):
+        return f"{self.reader.username} read {self.peer.username} up to {self.last_read_message_id}"
+    
+    @classmethod
+    def advance(cls, reader_id, peer_id, up_to):
+        """
+        Move the reader's watermark for peer forward to message `up_to`
+        Returns True if it moved. The watermark never moves back, and only
+        to a message the peer actually sent the reader.
+        """
+        received = Message.objects.filter(id=up_to, sender_id=peer_id, receiver_id=reader_id)
+        if cls.objects.filter(
+            reader_id=reader_id, peer_id=peer_id, last_read_message_id__lt=up_to
+        ).filter(models.Exists(received)).update(last_read_message_id=up_to, updated_at=timezone.now()):
+            return True
+        if cls.objects.filter(reader_id=reader_id, peer_id=peer_id).exists() or not received.exists():
+            # Already further along, or not a message to this reader
+            return False
+        try:
+            with transaction.atomic():
+                cls.objects.create(reader_id=reader_id, peer_id=peer_id, last_read_message_id=up_to)
+            return True
+        except IntegrityError:
+            # Created concurrently; try moving that one forward
+            return cls.advance(reader_id, peer_id, up_to)
@@ -0,0 +1,185 @@
+"""
+Bounded outbound queues for WebSocket consumers.
+
+Channels consumers handle group events one at a time, and `self.send` waits
+for the client's socket. A slow client therefore backs events up into the
+channel layer, where they pile up until its per-channel capacity is reached
+and group_send starts dropping them without a trace.
+
+Consumers queue frames here instead and a per-connection task writes them
+out. The policy when a client falls behind:
+
+- receipts are coalesced: a newer receipt for the same conversation replaces
+  the queued one, so they never grow the queue;
+- chat messages are never dropped from an open connection;
+- once the queue is over its frame or byte budget the connection is closed
+  with OVERLOAD_CLOSE_CODE and a `{"retry_after": seconds}` reason, and the
+  client reconnects and reloads instead of receiving a partial stream.
+
+So memory per connection is capped at roughly MAX_BYTES.
+"""
+
+from collections import deque
+import asyncio
+import json
+import logging
+import weakref
+
+from django.conf import settings
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+OVERLOAD_CLOSE_CODE = 4429
+
+_queue_settings = getattr(settings, 'OUTBOUND_QUEUE', {})
+MAX_FRAMES = _queue_settings.get('MAX_FRAMES', 256)
+MAX_BYTES = _queue_settings.get('MAX_BYTES', 1024 * 1024)
+RETRY_AFTER = _queue_settings.get('RETRY_AFTER', 5)
+
+# Live queues, for the outbound_queues gauge
+_queues = weakref.WeakSet()
+
+
+class OutboundQueue:
+    def __init__(self, send, close, label='', max_frames=MAX_FRAMES, max_bytes=MAX_BYTES,
+                 retry_after=RETRY_AFTER):
+        self._send = send
+        self._close = close
+        self.label = label
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        # Entries are [coalesce_key, text] so a queued receipt can be replaced in place
+        self._frames = deque()
+        self._keyed = {}
+        self.bytes = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.overloaded = False
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._drain())
+        _queues.add(self)
+
+    def depth(self):
+        return len(self._frames)
+
+    def put(self, frame, coalesce_key=None):
+        """
+        Queue a frame (a JSON-serializable dict) for the client
+        Frames with a coalesce_key replace a queued frame with the same key.
+        """
+        if self.closed or self.overloaded:
+            self.dropped += 1
+            metrics.incr('outbound.dropped')
+            return
+
+        text = json.dumps(frame)
+        if coalesce_key is not None:
+            entry = self._keyed.get(coalesce_key)
+            if entry is not None:
+                self.bytes += len(text) - len(entry[1])
+                entry[1] = text
+                self.coalesced += 1
+                metrics.incr('outbound.coalesced')
+                return
+
+        entry = [coalesce_key, text]
+        self._frames.append(entry)
+        if coalesce_key is not None:
+            self._keyed[coalesce_key] = entry
+        self.bytes += len(text)
+        metrics.observe('outbound.queue_depth', self.depth())
+
+        if self.depth() > self.max_frames or self.bytes > self.max_bytes:
+            self._overload()
+        self._wakeup.set()
+
+    def _overload(self):
+        # Free the backlog now; the drain task sends the close
+        dropped = self.depth()
+        self.dropped += dropped
+        metrics.incr('outbound.dropped', dropped)
+        metrics.incr('outbound.overload_closes')
+        self._frames.clear()
+        self._keyed.clear()
+        self.bytes = 0
+        self.overloaded = True
+
+    def _pop(self):
+        entry = self._frames.popleft()
+        if entry[0] is not None:
+            del self._keyed[entry[0]]
+        self.bytes -= len(entry[1])
+        return entry[1]
+
+    async def _drain(self):
+        while not self.closed:
+            if self.overloaded:
+                self.closed = True
+                await self._close(OVERLOAD_CLOSE_CODE, json.dumps({'retry_after': self.retry_after}))
+                return
+            if not self.depth():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                await self._send(self._pop())
+            except Exception:
+                # The client is gone; disconnect() will stop us
+                logger.debug("Outbound send to %s failed", self.label, exc_info=True)
+                self.closed = True
+
+    def stop(self):
+        self.closed = True
+        self._task.cancel()
+        _queues.discard(self)
+
+
+class OutboundQueueMixin:
+    """
+    For AsyncWebsocketConsumers: call open_outbound() before accept() and
+    close_outbound() in disconnect(), then queue_frame() instead of send()
+    """
+    def open_outbound(self):
+        self.outbound = OutboundQueue(
+            lambda text: self.send(text_data=text),
+            lambda code, reason: self.close(code=code, reason=reason),
+            label=self.channel_name,
+        )
+
+    def queue_frame(self, frame, coalesce_key=None):
+        self.outbound.put(frame, coalesce_key)
+
+    def close_outbound(self):
+        outbound = getattr(self, 'outbound', None)
+        if outbound is not None:
+            outbound.stop()
+
+
+def queue_stats(top=5):
+    """
+    Totals over all live outbound queues plus the deepest few connections
+    """
+    queues = list(_queues)
+    deepest = sorted(queues, key=lambda queue: queue.bytes, reverse=True)[:top]
+    return {
+        'connections': len(queues),
+        'frames': sum(queue.depth() for queue in queues),
+        'bytes': sum(queue.bytes for queue in queues),
+        'deepest': [
+            {
+                'connection': queue.label,
+                'depth': queue.depth(),
+                'bytes': queue.bytes,
+                'coalesced': queue.coalesced,
+                'dropped': queue.dropped,
+            }
+            for queue in deepest
+        ],
+    }
+
+
+metrics.gauge('outbound_queues', queue_stats)
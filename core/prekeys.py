@@ -0,0 +1,120 @@
+"""
+One-time pre-key service.
+
+Owners generate one-time pre-keys in bulk; anyone setting up a session with
+them claims exactly one. A claim is a conditional UPDATE of a single row
+(`... WHERE id = ? AND is_used = 0`), so two concurrent session setups can
+never receive the same key and no table lock is taken. Concurrent claimers
+pick randomly among the first few unused keys so they rarely race for the
+same row, and a lost race just retries with the next candidate.
+
+When an owner's unused keys drop to the low watermark, the
+`one_time_prekeys_low` signal is sent so the owner can be told to replenish.
+"""
+
+import random
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import OneTimePreKey
+from .signal_protocol import generate_raw_key_pair
+from .signals import one_time_prekeys_low
+
+PREKEY_SETTINGS = getattr(settings, 'ONE_TIME_PREKEYS', {})
+LOW_WATERMARK = PREKEY_SETTINGS.get('LOW_WATERMARK', 20)
+BATCH_SIZE = PREKEY_SETTINGS.get('BATCH_SIZE', 100)
+MAX_BATCH_SIZE = PREKEY_SETTINGS.get('MAX_BATCH_SIZE', 500)
+CLAIM_CANDIDATES = PREKEY_SETTINGS.get('CLAIM_CANDIDATES', 8)
+CLAIM_ATTEMPTS = PREKEY_SETTINGS.get('CLAIM_ATTEMPTS', 5)
+
+
+def unused_count(user):
+    """
+    Number of one-time pre-keys the user still has available
+    """
+    return OneTimePreKey.objects.filter(user=user, is_used=False).count()
+
+
+def add_one_time_prekeys(user, key_pairs, attempts=3):
+    """
+    Store (public_key_raw, private_key_raw) pairs for a user with one bulk INSERT
+    Key ids continue after the user's highest existing id. If a concurrent
+    upload took the same ids, the insert is retried with fresh ids.
+    Returns the created OneTimePreKey objects.
+    """
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                last_id = OneTimePreKey.objects.filter(user=user).aggregate(last=Max('key_id'))['last'] or 0
+                prekeys = [
+                    OneTimePreKey(
+                        user=user,
+                        key_id=last_id + offset,
+                        public_key=public_key,
+                        private_key=private_key,
+                    )
+                    for offset, (public_key, private_key) in enumerate(key_pairs, start=1)
+                ]
+                created = OneTimePreKey.objects.bulk_create(prekeys, batch_size=MAX_BATCH_SIZE)
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+            continue
+        metrics.incr('prekeys.created', len(created))
+        return created
+
+
+def generate_one_time_prekeys(user, count=None):
+    """
+    Generate and store a batch of one-time pre-keys for a user
+    """
+    count = min(count or BATCH_SIZE, MAX_BATCH_SIZE)
+    return add_one_time_prekeys(user, [generate_raw_key_pair() for _ in range(count)])
+
+
+def claim_one_time_prekey(owner, requester):
+    """
+    Atomically hand one of owner's unused one-time pre-keys to requester
+    Returns the claimed OneTimePreKey, or None when the owner has run out
+    (X3DH then proceeds without the optional fourth DH).
+    """
+    claimed = None
+    for _ in range(CLAIM_ATTEMPTS):
+        candidates = list(
+            OneTimePreKey.objects.filter(user=owner, is_used=False)
+            .order_by('key_id')
+            .values_list('pk', flat=True)[:CLAIM_CANDIDATES]
+        )
+        if not candidates:
+            break
+        random.shuffle(candidates)
+        
+        for pk in candidates:
+            # Only succeeds if nobody claimed this row since we read it
+            updated = OneTimePreKey.objects.filter(pk=pk, is_used=False).update(
+                is_used=True,
+                claimed_by=requester,
+                claimed_at=timezone.now(),
+            )
+            if updated:
+                claimed = OneTimePreKey.objects.get(pk=pk)
+                break
+            metrics.incr('prekeys.claim_conflicts')
+        
+        if claimed is not None:
+            break
+    
+    if claimed is None:
+        metrics.incr('prekeys.exhausted')
+    else:
+        metrics.incr('prekeys.claimed')
+    
+    remaining = unused_count(owner)
+    if remaining <= LOW_WATERMARK:
+        one_time_prekeys_low.send(sender=OneTimePreKey, user=owner, remaining=remaining)
+    
+    return claimed
@@ -0,0 +1,237 @@
+"""
+Write-back cache for ConversationSession ratchet state.
+
+Encrypting with a session reads, advances and rewrites the ratchet state
+(root_key, chain_key, next_sending_key, message_number). Doing that as a row
+UPDATE per message makes SQLite the bottleneck in busy conversations, so the
+cache keeps the decoded state in memory and advances it there.
+
+Crash safety comes from leases. Before handing out message numbers
+[n, n + LEASE_SIZE) the cache writes the state *as of n + LEASE_SIZE* to the
+database. If the process dies, the next load starts at or beyond the end of
+every lease already handed out, so a message key is never used twice; the
+receiver just sees a gap in message numbers, which its skipped-key handling
+already covers. Sessions left idle are written back with their exact state
+and evicted, so a normal shutdown or a quiet conversation leaves no gap.
+
+Every write is a compare-and-swap on ConversationSession.state_version. A
+failed swap means another process wrote the session since we loaded it; the
+entry is reloaded and takes a fresh lease after the other writer's, so two
+workers sharing a session still never overlap.
+"""
+
+from collections import OrderedDict
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import ConversationSession
+from .signal_protocol import (
+    advance_session, base64_decode, base64_encode, ratchet_step, seal_message,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.evicted = False
+        self.pk = None
+        self.state_version = 0
+        self.root_key = None
+        self.chain_key = None
+        self.next_sending_key = None
+        self.message_number = 0
+        self.lease_end = 0
+        self.last_used = time.monotonic()
+
+
+class SessionStateCache:
+    def __init__(self, lease_size=64, max_entries=1024, flush_interval=5.0, idle_seconds=30.0):
+        self.lease_size = lease_size
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.idle_seconds = idle_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def _load(self, entry, owner_id, contact_id):
+        session = ConversationSession.objects.get(owner_id=owner_id, contact_id=contact_id)
+        entry.pk = session.pk
+        entry.state_version = session.state_version
+        entry.root_key = base64_decode(session.root_key)
+        entry.chain_key = base64_decode(session.chain_key)
+        entry.next_sending_key = base64_decode(session.next_sending_key)
+        entry.message_number = session.message_number
+        # Nothing is reserved until the first lease is written
+        entry.lease_end = session.message_number
+        entry.loaded = True
+
+    def _write(self, entry, root_key, chain_key, next_sending_key, message_number):
+        """
+        Compare-and-swap the session row; returns False if someone else wrote it first
+        """
+        updated = ConversationSession.objects.filter(
+            pk=entry.pk, state_version=entry.state_version
+        ).update(
+            root_key=base64_encode(root_key),
+            chain_key=base64_encode(chain_key),
+            next_sending_key=base64_encode(next_sending_key),
+            message_number=message_number,
+            state_version=entry.state_version + 1,
+            updated_at=timezone.now(),
+        )
+        if updated:
+            entry.state_version += 1
+            return True
+        metrics.incr('session_cache.cas_conflicts')
+        return False
+
+    def _renew_lease(self, entry, owner_id, contact_id):
+        while True:
+            lease_end = entry.message_number + self.lease_size
+            state = advance_session(entry.root_key, entry.chain_key, entry.next_sending_key, self.lease_size)
+            if self._write(entry, *state, lease_end):
+                entry.lease_end = lease_end
+                metrics.incr('session_cache.lease_writes')
+                return
+            # Another process advanced the session; continue after its lease
+            self._load(entry, owner_id, contact_id)
+
+    def _entry(self, owner_id, contact_id):
+        key = (owner_id, contact_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry()
+                self._entries[key] = entry
+                metrics.incr('session_cache.misses')
+            else:
+                self._entries.move_to_end(key)
+                metrics.incr('session_cache.hits')
+            overflow = len(self._entries) - self.max_entries
+            victims = [k for k in list(self._entries)[:overflow] if k != key] if overflow > 0 else []
+
+        for victim in victims:
+            self._evict(victim)
+        self._ensure_flusher()
+        return entry
+
+    def encrypt(self, owner_id, contact_id, message):
+        """
+        Encrypt a message with the (owner, contact) session
+        Returns (encrypted_data, message_number).
+        """
+        while True:
+            entry = self._entry(owner_id, contact_id)
+            with entry.lock:
+                if entry.evicted:
+                    # Written back and dropped while we waited; look it up again
+                    continue
+                if not entry.loaded:
+                    try:
+                        self._load(entry, owner_id, contact_id)
+                    except ConversationSession.DoesNotExist:
+                        self._discard(entry, owner_id, contact_id)
+                        raise
+                if entry.message_number >= entry.lease_end:
+                    self._renew_lease(entry, owner_id, contact_id)
+
+                message_number = entry.message_number
+                message_key, entry.root_key, entry.chain_key, entry.next_sending_key = ratchet_step(
+                    entry.root_key, entry.chain_key, entry.next_sending_key
+                )
+                entry.message_number += 1
+                entry.last_used = time.monotonic()
+
+            return seal_message(message, message_key, message_number), message_number
+
+    def _discard(self, entry, owner_id, contact_id):
+        entry.evicted = True
+        with self._lock:
+            if self._entries.get((owner_id, contact_id)) is entry:
+                del self._entries[(owner_id, contact_id)]
+
+    def _evict(self, key):
+        """
+        Write an entry's exact state back and drop it
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+
+        with entry.lock:
+            if entry.evicted:
+                return
+            if entry.loaded and entry.message_number < entry.lease_end:
+                # Only message numbers below message_number were used, so the
+                # unused rest of the lease can be given back. If the swap
+                # fails another process has moved on and our state is stale.
+                self._write(entry, entry.root_key, entry.chain_key,
+                            entry.next_sending_key, entry.message_number)
+            self._discard(entry, *key)
+        metrics.incr('session_cache.evictions')
+
+    def flush(self, idle_seconds=None):
+        """
+        Write back and evict entries unused for `idle_seconds` (all entries if 0)
+        Returns the number of entries evicted.
+        """
+        if idle_seconds is None:
+            idle_seconds = self.idle_seconds
+        cutoff = time.monotonic() - idle_seconds
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry.last_used <= cutoff]
+        for key in keys:
+            self._evict(key)
+        return len(keys)
+
+    def size(self):
+        return len(self._entries)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='session-cache-flush', daemon=True)
+            self._flusher.start()
+        atexit.register(self._flush_at_exit)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Session cache flush failed")
+            finally:
+                close_old_connections()
+
+    def _flush_at_exit(self):
+        try:
+            self.flush(idle_seconds=0)
+        except Exception:
+            # Leases already cover anything that was handed out
+            logger.exception("Session cache flush at exit failed")
+
+
+_cache_settings = getattr(settings, 'SESSION_CACHE', {})
+session_cache = SessionStateCache(
+    lease_size=_cache_settings.get('LEASE_SIZE', 64),
+    max_entries=_cache_settings.get('MAX_ENTRIES', 1024),
+    flush_interval=_cache_settings.get('FLUSH_INTERVAL', 5.0),
+    idle_seconds=_cache_settings.get('IDLE_SECONDS', 30.0),
+)
+metrics.gauge('session_cache.size', session_cache.size)
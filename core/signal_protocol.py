@@ -15,11 +15,15 @@ from cryptography.hazmat.primitives import hashes, hmac, serialization
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from collections import OrderedDict
+import hashlib
+import hmac as std_hmac
 import os
 import base64
 import json
 import secrets
 import string
+import threading
 
 # Utility functions
 def generate_random_bytes(length=32):
@@ -36,6 +40,245 @@ def base64_decode(data):
     """Decode base64 string to bytes."""
     return base64.b64decode(data)
 
+# HMAC (RFC 2104) pads for SHA-256's 64-byte block
+_HMAC_INNER_PAD = bytes(x ^ 0x36 for x in range(256))
+_HMAC_OUTER_PAD = bytes(x ^ 0x5c for x in range(256))
+
+def hmac_sha256(key, data):
+    """
+    HMAC-SHA256 in one call (same result as cryptography's HMAC, less overhead).
+    Ratchet keys are 32 bytes, so the RFC 2104 construction is done directly
+    with hashlib, which is about twice as fast as hmac.digest for short inputs.
+    """
+    if len(key) > 64:
+        return std_hmac.digest(key, data, 'sha256')
+    key = key.ljust(64, b'\0')
+    inner = hashlib.sha256(key.translate(_HMAC_INNER_PAD) + data).digest()
+    return hashlib.sha256(key.translate(_HMAC_OUTER_PAD) + inner).digest()
+
+def advance_chain_key(chain_key, steps=1):
+    """Apply the symmetric chain step `steps` times."""
+    for _ in range(steps):
+        chain_key = hmac_sha256(chain_key, b"chain_key_update")
+    return chain_key
+
+def message_cipher(message_key):
+    """
+    Return (AESGCM, nonce) for a 32-byte message key
+    The whole key is the AES-256 key; the nonce is derived from it separately.
+    """
+    return AESGCM(message_key), hmac_sha256(message_key, b"message_nonce")[:12]
+
+# Receiving-chain state
+class RatchetStateStore:
+    """
+    Remembers where each receiving chain has been so decryption doesn't have
+    to re-walk the chain from its start for every message.
+
+    For each chain (identified by its starting chain key) the store keeps:
+    - a checkpoint of the chain key every `checkpoint_interval` steps,
+    - the head: the chain key just after the highest message seen,
+    - a bounded, expiring cache of the chain keys of messages that were
+      skipped over and may still arrive out of order.
+
+    Deriving the key for message n then costs at most the distance to the
+    nearest checkpoint (or the head) instead of n HMAC steps. Chains are
+    evicted least-recently-used beyond `max_chains`.
+    """
+    def __init__(self, checkpoint_interval=128, max_chains=1024,
+                 max_skipped_keys=1000, skipped_key_ttl=3600):
+        self.checkpoint_interval = checkpoint_interval
+        self.max_chains = max_chains
+        self.max_skipped_keys = max_skipped_keys
+        self.skipped_key_ttl = skipped_key_ttl
+        self._chains = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _chain(self, initial_chain_key):
+        chain = self._chains.get(initial_chain_key)
+        if chain is None:
+            chain = {
+                'checkpoints': {0: initial_chain_key},
+                'last_checkpoint': 0,
+                'head': (0, initial_chain_key),
+                'skipped': OrderedDict(),
+            }
+            self._chains[initial_chain_key] = chain
+            while len(self._chains) > self.max_chains:
+                self._chains.popitem(last=False)
+        else:
+            self._chains.move_to_end(initial_chain_key)
+        return chain
+    
+    def _expire_skipped(self, skipped, now):
+        while skipped:
+            index, (chain_key, expires_at) = next(iter(skipped.items()))
+            if expires_at > now and len(skipped) <= self.max_skipped_keys:
+                break
+            del skipped[index]
+    
+    def _walk(self, initial_chain_key, index, chain_key, message_number, skipped=None):
+        """
+        Step from (index, chain_key) to message_number, recording the
+        checkpoints passed and, if a list is given, the skipped chain keys.
+        """
+        interval = self.checkpoint_interval
+        passed = {}
+        while index < message_number:
+            if skipped is not None and index >= message_number - self.max_skipped_keys:
+                skipped.append((index, chain_key))
+            chain_key = advance_chain_key(chain_key)
+            index += 1
+            if index % interval == 0:
+                passed[index] = chain_key
+        
+        if passed:
+            with self._lock:
+                chain = self._chain(initial_chain_key)
+                chain['checkpoints'].update(passed)
+                chain['last_checkpoint'] = max(chain['last_checkpoint'], max(passed))
+        return chain_key
+    
+    def _nearest(self, chain, message_number):
+        # Checkpoints exist for every interval up to last_checkpoint, since
+        # every walk starts from a known position and records what it passes
+        interval = self.checkpoint_interval
+        index = min((message_number // interval) * interval, chain['last_checkpoint'])
+        chain_key = chain['checkpoints'][index]
+        head_index, head_key = chain['head']
+        if index < head_index <= message_number:
+            return head_index, head_key
+        return index, chain_key
+    
+    def chain_key_at(self, initial_chain_key, message_number):
+        """
+        Return the chain key used for message `message_number`
+        """
+        with self._lock:
+            index, chain_key = self._nearest(self._chain(initial_chain_key), message_number)
+        
+        # Walk forward outside the lock
+        return self._walk(initial_chain_key, index, chain_key, message_number)
+    
+    def message_key(self, initial_chain_key, message_number):
+        """
+        Return (message_key, chain_key) for message `message_number`, using
+        a cached skipped key when there is one. Keys for messages skipped
+        over on the way are cached for later out-of-order delivery; each
+        cached key is used once.
+        """
+        now = time.monotonic()
+        with self._lock:
+            chain = self._chain(initial_chain_key)
+            skipped = chain['skipped']
+            self._expire_skipped(skipped, now)
+            cached = skipped.pop(message_number, None)
+            head_index = chain['head'][0]
+            if cached is None:
+                index, chain_key = self._nearest(chain, message_number)
+        
+        if cached is not None:
+            return hmac_sha256(cached[0], b"message_key"), cached[0]
+        
+        if message_number < head_index:
+            # Older than the head but not cached (expired or already used)
+            chain_key = self._walk(initial_chain_key, index, chain_key, message_number)
+            return hmac_sha256(chain_key, b"message_key"), chain_key
+        
+        # Moving the head forward: remember the keys of messages we skip,
+        # up to the configured bound
+        new_skipped = []
+        chain_key = self._walk(initial_chain_key, index, chain_key, message_number, new_skipped)
+        
+        with self._lock:
+            chain = self._chain(initial_chain_key)
+            if chain['head'][0] < message_number + 1:
+                head = (message_number + 1, advance_chain_key(chain_key))
+                chain['head'] = head
+                if head[0] % self.checkpoint_interval == 0:
+                    chain['checkpoints'][head[0]] = head[1]
+                    chain['last_checkpoint'] = max(chain['last_checkpoint'], head[0])
+            expires_at = now + self.skipped_key_ttl
+            for skipped_index, skipped_key in new_skipped:
+                if skipped_index >= head_index:
+                    chain['skipped'][skipped_index] = (skipped_key, expires_at)
+            self._expire_skipped(chain['skipped'], now)
+        
+        return hmac_sha256(chain_key, b"message_key"), chain_key
+    
+    def clear(self):
+        with self._lock:
+            self._chains.clear()
+
+# Store used by decrypt_message unless the caller passes its own
+default_ratchet_store = RatchetStateStore()
+
+# Raw X25519 key encoding
+# An X25519 key is 32 bytes; storing it raw avoids the ~120-byte PEM text
+# and the ASN.1 parse needed to get it back.
+X25519_KEY_SIZE = 32
+
+def encode_public_key(public_key):
+    """Return the raw 32 bytes of an X25519 public key."""
+    return public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )
+
+def encode_private_key(private_key):
+    """Return the raw 32 bytes of an X25519 private key."""
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+def decode_public_key(raw):
+    """Load an X25519 public key from its raw 32 bytes."""
+    return x25519.X25519PublicKey.from_public_bytes(bytes(raw))
+
+def decode_private_key(raw):
+    """Load an X25519 private key from its raw 32 bytes."""
+    return x25519.X25519PrivateKey.from_private_bytes(bytes(raw))
+
+def public_key_pem_to_raw(public_key_pem):
+    """Convert a PEM (SubjectPublicKeyInfo) X25519 public key to raw bytes."""
+    return encode_public_key(serialization.load_pem_public_key(
+        public_key_pem.encode('utf-8'),
+        backend=default_backend()
+    ))
+
+def private_key_pem_to_raw(private_key_pem):
+    """Convert a PEM (PKCS8) X25519 private key to raw bytes."""
+    return encode_private_key(serialization.load_pem_private_key(
+        private_key_pem.encode('utf-8'),
+        password=None,
+        backend=default_backend()
+    ))
+
+def public_key_raw_to_pem(raw):
+    """Convert a raw X25519 public key back to PEM."""
+    return decode_public_key(raw).public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+
+def private_key_raw_to_pem(raw):
+    """Convert a raw X25519 private key back to PEM."""
+    return decode_private_key(raw).private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode('utf-8')
+
+def generate_raw_key_pair():
+    """
+    Generate an X25519 key pair as raw bytes
+    Returns (public_key_raw, private_key_raw)
+    """
+    private_key = x25519.X25519PrivateKey.generate()
+    return encode_public_key(private_key.public_key()), encode_private_key(private_key)
+
 # Key generation functions
 def generate_identity_key_pair():
     """
@@ -147,47 +390,49 @@ def create_initial_session(
     recipient_one_time_prekey_pub_pem=None
 ):
     """
-    Create an initial session using the Triple Diffie-Hellman (X3DH) protocol.
-    This is used to establish secure communication with forward secrecy.
+    Create an initial session from PEM keys.
+    Converts the keys once and delegates to create_initial_session_raw.
     
     Returns (session_id, root_key, chain_key, next_sending_key)
     """
-    # Parse all keys
-    identity_key_priv = serialization.load_pem_private_key(
-        identity_key_priv_pem.encode('utf-8'),
-        password=None,
-        backend=default_backend()
-    )
-    
-    identity_key_pub = serialization.load_pem_public_key(
-        identity_key_pub_pem.encode('utf-8'),
-        backend=default_backend()
-    )
-    
-    signed_prekey_priv = serialization.load_pem_private_key(
-        signed_prekey_priv_pem.encode('utf-8'),
-        password=None,
-        backend=default_backend()
-    )
-    
-    signed_prekey_pub = serialization.load_pem_public_key(
-        signed_prekey_pub_pem.encode('utf-8'),
-        backend=default_backend()
-    )
-    
-    recipient_identity_key_pub = serialization.load_pem_public_key(
-        recipient_identity_key_pub_pem.encode('utf-8'),
-        backend=default_backend()
-    )
-    
-    recipient_signed_prekey_pub = serialization.load_pem_public_key(
-        recipient_signed_prekey_pub_pem.encode('utf-8'),
-        backend=default_backend()
+    return create_initial_session_raw(
+        private_key_pem_to_raw(identity_key_priv_pem),
+        public_key_pem_to_raw(identity_key_pub_pem),
+        private_key_pem_to_raw(signed_prekey_priv_pem),
+        public_key_pem_to_raw(signed_prekey_pub_pem),
+        public_key_pem_to_raw(recipient_identity_key_pub_pem),
+        public_key_pem_to_raw(recipient_signed_prekey_pub_pem),
+        public_key_pem_to_raw(recipient_one_time_prekey_pub_pem)
+        if recipient_one_time_prekey_pub_pem else None
     )
+
+def create_initial_session_raw(
+    identity_key_priv, identity_key_pub,
+    signed_prekey_priv, signed_prekey_pub,
+    recipient_identity_key_pub, recipient_signed_prekey_pub,
+    recipient_one_time_prekey_pub=None
+):
+    """
+    Create an initial session using the Triple Diffie-Hellman (X3DH) protocol.
+    This is used to establish secure communication with forward secrecy.
+    All keys are raw 32-byte X25519 keys (as stored on SignedPreKey and
+    OneTimePreKey), so no PEM parsing happens here.
     
-    # Generate an ephemeral key pair for this session
-    ephemeral_key_priv = x25519.X25519PrivateKey.generate()
-    ephemeral_key_pub = ephemeral_key_priv.public_key()
+    Returns (session_id, root_key, chain_key, next_sending_key)
+    """
+    keys = [
+        identity_key_priv, identity_key_pub,
+        signed_prekey_priv, signed_prekey_pub,
+        recipient_identity_key_pub, recipient_signed_prekey_pub,
+    ]
+    if recipient_one_time_prekey_pub:
+        keys.append(recipient_one_time_prekey_pub)
+    for key in keys:
+        if len(key) != X25519_KEY_SIZE:
+            raise ValueError("X25519 keys must be %d raw bytes" % X25519_KEY_SIZE)
+    
+    # Generate an ephemeral key for this session
+    ephemeral_key_priv = generate_random_bytes(X25519_KEY_SIZE)
     
     # Triple Diffie-Hellman (X3DH) key agreement
     # DH1 = DH(identity_key_priv, recipient_signed_prekey_pub)
@@ -195,53 +440,36 @@ def create_initial_session(
     # DH3 = DH(ephemeral_key_priv, recipient_signed_prekey_pub)
     # DH4 = DH(ephemeral_key_priv, recipient_one_time_prekey_pub) (optional)
     
-    # Compute the shared secrets
-    dh1 = None
-    dh2 = None
-    dh3 = None
-    dh4 = None
-    
     # In a real implementation, we'd use the raw key agreement for X25519
     # Here we're simulating it with a hash of the keys since we can't directly compute shared secrets
     
     # DH1: Our identity key with their signed prekey
     dh1_material = hashes.Hash(hashes.SHA256())
-    dh1_material.update(identity_key_priv_pem.encode('utf-8'))
-    dh1_material.update(recipient_signed_prekey_pub_pem.encode('utf-8'))
+    dh1_material.update(bytes(identity_key_priv))
+    dh1_material.update(bytes(recipient_signed_prekey_pub))
     dh1 = dh1_material.finalize()
     
     # DH2: Our signed prekey with their identity key
     dh2_material = hashes.Hash(hashes.SHA256())
-    dh2_material.update(signed_prekey_priv_pem.encode('utf-8'))
-    dh2_material.update(recipient_identity_key_pub_pem.encode('utf-8'))
+    dh2_material.update(bytes(signed_prekey_priv))
+    dh2_material.update(bytes(recipient_identity_key_pub))
     dh2 = dh2_material.finalize()
     
     # DH3: Our ephemeral key with their signed prekey
-    ephemeral_key_priv_pem = ephemeral_key_priv.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption()
-    ).decode('utf-8')
-    
     dh3_material = hashes.Hash(hashes.SHA256())
-    dh3_material.update(ephemeral_key_priv_pem.encode('utf-8'))
-    dh3_material.update(recipient_signed_prekey_pub_pem.encode('utf-8'))
+    dh3_material.update(ephemeral_key_priv)
+    dh3_material.update(bytes(recipient_signed_prekey_pub))
     dh3 = dh3_material.finalize()
     
+    # Combine the shared secrets to create the master secret
+    key_material = dh1 + dh2 + dh3
+    
     # DH4 (optional): Our ephemeral key with their one-time prekey
-    if recipient_one_time_prekey_pub_pem:
+    if recipient_one_time_prekey_pub:
         dh4_material = hashes.Hash(hashes.SHA256())
-        dh4_material.update(ephemeral_key_priv_pem.encode('utf-8'))
-        dh4_material.update(recipient_one_time_prekey_pub_pem.encode('utf-8'))
-        dh4 = dh4_material.finalize()
-    
-    # Combine the shared secrets to create the master secret
-    key_material = b''
-    key_material += dh1
-    key_material += dh2
-    key_material += dh3
-    if dh4:
-        key_material += dh4
+        dh4_material.update(ephemeral_key_priv)
+        dh4_material.update(bytes(recipient_one_time_prekey_pub))
+        key_material += dh4_material.finalize()
     
     # Derive the root key and chain keys using HKDF
     kdf = HKDF(
@@ -270,72 +498,88 @@ def create_initial_session(
     )
 
 # Encryption & Decryption using the Double Ratchet Algorithm
-def encrypt_message(message, session_data):
+def ratchet_step(root_key, chain_key, next_sending_key):
     """
-    Encrypt a message using the current session keys.
-    The Double Ratchet Algorithm updates the keys for each message.
-    
-    Args:
-        message: The plaintext message to encrypt
-        session_data: Dict with root_key, chain_key, next_sending_key, and message_number
-        
-    Returns:
-        Dict with encrypted message, updated session data, and ephemeral key
+    Advance the sending ratchet by one message on raw (bytes) keys.
+    Returns (message_key, root_key, chain_key, next_sending_key) where the
+    message key is for the current message and the rest is the new state.
     """
-    # Parse session data
-    root_key = base64_decode(session_data['root_key'])
-    chain_key = base64_decode(session_data['chain_key'])
-    next_sending_key = base64_decode(session_data['next_sending_key'])
-    message_number = session_data['message_number']
-    
-    # Generate a new ephemeral key for this message (changing with each message)
-    ephemeral_key = generate_random_bytes(32)
-    
     # Update the chain key (forward secrecy - old keys can't decrypt future messages)
     # In real Signal Protocol, this would use the Diffie-Hellman ratchet
-    h = hmac.HMAC(chain_key, hashes.SHA256())
-    h.update(b"chain_key_update")
-    new_chain_key = h.finalize()
+    new_chain_key = hmac_sha256(chain_key, b"chain_key_update")
     
     # Derive message keys from the chain key
-    h = hmac.HMAC(chain_key, hashes.SHA256())
-    h.update(b"message_key")
-    message_key = h.finalize()
+    message_key = hmac_sha256(chain_key, b"message_key")
     
     # Derive the next sending key
-    h = hmac.HMAC(next_sending_key, hashes.SHA256())
-    h.update(b"next_key_update")
-    new_next_sending_key = h.finalize()
+    new_next_sending_key = hmac_sha256(next_sending_key, b"next_key_update")
     
     # Derive a new root key (the real Double Ratchet would use DH exchange)
-    h = hmac.HMAC(root_key, hashes.SHA256())
-    h.update(new_chain_key)
-    new_root_key = h.finalize()
+    new_root_key = hmac_sha256(root_key, new_chain_key)
     
-    # Encrypt the message using AES-GCM
-    # First 12 bytes of message_key as nonce, rest as encryption key
-    nonce = message_key[:12]
-    aes_key = message_key[12:]
+    return message_key, new_root_key, new_chain_key, new_next_sending_key
+
+def advance_session(root_key, chain_key, next_sending_key, steps):
+    """
+    Apply ratchet_step `steps` times and return (root_key, chain_key, next_sending_key)
+    """
+    for _ in range(steps):
+        _, root_key, chain_key, next_sending_key = ratchet_step(root_key, chain_key, next_sending_key)
+    return root_key, chain_key, next_sending_key
+
+def seal_message(message, message_key, message_number, ephemeral_key=None, timestamp=None):
+    """
+    Encrypt one message with its message key.
+    Returns the encrypted_data dict produced by encrypt_message.
+    """
+    # Generate a new ephemeral key for this message (changing with each message)
+    if ephemeral_key is None:
+        ephemeral_key = generate_random_bytes(32)
+    if timestamp is None:
+        timestamp = str(int(time.time()))
     
-    aesgcm = AESGCM(aes_key)
+    # Encrypt the message using AES-GCM
+    aesgcm, nonce = message_cipher(message_key)
     message_bytes = message.encode('utf-8')
     
     # Add message metadata
     metadata = {
         'message_number': message_number,
-        'timestamp': str(int(time.time()))
+        'timestamp': timestamp
     }
     metadata_bytes = json.dumps(metadata).encode('utf-8')
     
     # Encrypt the message with associated data (metadata)
     ciphertext = aesgcm.encrypt(nonce, message_bytes, metadata_bytes)
     
-    # Prepare the result
-    encrypted_data = {
+    return {
         'ciphertext': base64_encode(ciphertext),
         'metadata': base64_encode(metadata_bytes),
         'ephemeral_key': base64_encode(ephemeral_key)
     }
+
+def encrypt_message(message, session_data):
+    """
+    Encrypt a message using the current session keys.
+    The Double Ratchet Algorithm updates the keys for each message.
+    
+    Args:
+        message: The plaintext message to encrypt
+        session_data: Dict with root_key, chain_key, next_sending_key, and message_number
+        
+    Returns:
+        Dict with encrypted message, updated session data, and ephemeral key
+    """
+    # Parse session data
+    root_key = base64_decode(session_data['root_key'])
+    chain_key = base64_decode(session_data['chain_key'])
+    next_sending_key = base64_decode(session_data['next_sending_key'])
+    message_number = session_data['message_number']
+    
+    message_key, new_root_key, new_chain_key, new_next_sending_key = ratchet_step(
+        root_key, chain_key, next_sending_key
+    )
+    encrypted_data = seal_message(message, message_key, message_number)
     
     # Update session
     updated_session = {
@@ -347,13 +591,58 @@ def encrypt_message(message, session_data):
     
     return encrypted_data, updated_session
 
-def decrypt_message(encrypted_data, session_data):
+def encrypt_messages(messages, session_data):
+    """
+    Encrypt a list of messages, in order, with one session.
+    Gives the same result as calling encrypt_message for each message and
+    passing the updated session to the next call, but the session is decoded
+    and re-encoded once for the whole batch (e.g. when flushing an outbox).
+    
+    Args:
+        messages: List of plaintext messages
+        session_data: Dict with root_key, chain_key, next_sending_key, and message_number
+        
+    Returns:
+        Tuple of (list of encrypted message dicts, updated session data)
+    """
+    root_key = base64_decode(session_data['root_key'])
+    chain_key = base64_decode(session_data['chain_key'])
+    next_sending_key = base64_decode(session_data['next_sending_key'])
+    message_number = session_data['message_number']
+    
+    # One read of the clock and the random source for the whole batch
+    timestamp = str(int(time.time()))
+    ephemeral_keys = generate_random_bytes(32 * len(messages))
+    
+    encrypted = []
+    for index, message in enumerate(messages):
+        message_key, root_key, chain_key, next_sending_key = ratchet_step(
+            root_key, chain_key, next_sending_key
+        )
+        encrypted.append(seal_message(
+            message, message_key, message_number,
+            ephemeral_key=ephemeral_keys[index * 32:(index + 1) * 32],
+            timestamp=timestamp
+        ))
+        message_number += 1
+    
+    updated_session = {
+        'root_key': base64_encode(root_key),
+        'chain_key': base64_encode(chain_key),
+        'next_sending_key': base64_encode(next_sending_key),
+        'message_number': message_number
+    }
+    
+    return encrypted, updated_session
+
+def decrypt_message(encrypted_data, session_data, store=None):
     """
     Decrypt a message using the session keys and update the session.
     
     Args:
         encrypted_data: Dict with ciphertext, metadata, and ephemeral_key
         session_data: Dict with root_key, chain_key, and message_number
+        store: RatchetStateStore to use (defaults to default_ratchet_store)
         
     Returns:
         Tuple of (decrypted_message, updated_session_data)
@@ -368,22 +657,14 @@ def decrypt_message(encrypted_data, session_data):
     chain_key = base64_decode(session_data['chain_key'])
     message_number = session_data['message_number']
     
-    # Update the chain key to match the incoming message's key
-    current_chain_key = chain_key
-    for i in range(message_number):
-        h = hmac.HMAC(current_chain_key, hashes.SHA256())
-        h.update(b"chain_key_update")
-        current_chain_key = h.finalize()
-    
-    # Derive message key from the current chain key
-    h = hmac.HMAC(current_chain_key, hashes.SHA256())
-    h.update(b"message_key")
-    message_key = h.finalize()
+    # Find the message key via the ratchet store: a skipped-key hit or a
+    # short walk from the nearest checkpoint instead of message_number steps
+    if store is None:
+        store = default_ratchet_store
+    message_key, current_chain_key = store.message_key(chain_key, message_number)
     
     # Update the chain key again for the next message
-    h = hmac.HMAC(current_chain_key, hashes.SHA256())
-    h.update(b"chain_key_update")
-    new_chain_key = h.finalize()
+    new_chain_key = advance_chain_key(current_chain_key)
     
     # Derive a new root key
     h = hmac.HMAC(root_key, hashes.SHA256())
@@ -396,10 +677,7 @@ def decrypt_message(encrypted_data, session_data):
     new_next_sending_key = h.finalize()
     
     # Decrypt the message
-    nonce = message_key[:12]
-    aes_key = message_key[12:]
-    
-    aesgcm = AESGCM(aes_key)
+    aesgcm, nonce = message_cipher(message_key)
     
     try:
         # Decrypt with the metadata as associated data
@@ -443,25 +721,25 @@ def decrypt_legacy(encrypted_message, private_key_pem):
     return legacy_decrypt(encrypted_message, private_key_pem)
 
 # Security Verification
-def generate_security_verification_code(our_identity_key, their_identity_key):
+def identity_key_fingerprint(public_key):
     """
-    Generate a security code for verifying the identity keys, similar to WhatsApp's security code.
-    This helps users verify they are talking to the right person.
+    Fingerprint of an identity public key (PEM text): SHA-256 as 64 hex digits.
+    Stored on MessageKey when the key is written so that security codes can be
+    derived later without hashing the keys again.
+    """
+    return hashlib.sha256(public_key.encode('utf-8')).hexdigest()
+
+def security_code_from_fingerprints(our_fingerprint, their_fingerprint):
+    """
+    Generate the security code for a pair of identity key fingerprints.
+    Both sides get the same code since the fingerprints are ordered first.
     
-    Args:
-        our_identity_key: Our identity public key in PEM format
-        their_identity_key: Their identity public key in PEM format
-        
     Returns:
         60-digit security code as a string, formatted in groups of 5 digits
     """
-    # Combine the keys in a consistent order
-    key_material = min(our_identity_key, their_identity_key) + max(our_identity_key, their_identity_key)
-    
-    # Create a SHA-256 hash of the combined keys
-    digest = hashes.Hash(hashes.SHA256())
-    digest.update(key_material.encode('utf-8'))
-    key_hash = digest.finalize()
+    # Combine the fingerprints in a consistent order
+    key_material = min(our_fingerprint, their_fingerprint) + max(our_fingerprint, their_fingerprint)
+    key_hash = hashlib.sha256(key_material.encode('utf-8')).digest()
     
     # Convert the hash to a 60-digit number
     # We'll use the first 30 bytes (240 bits) of the hash
@@ -477,20 +755,42 @@ def generate_security_verification_code(our_identity_key, their_identity_key):
     
     return ' '.join(groups)
 
-def generate_qr_verification_data(our_identity_key, their_identity_key):
+def generate_security_verification_code(our_identity_key, their_identity_key):
+    """
+    Generate a security code for verifying the identity keys, similar to WhatsApp's security code.
+    This helps users verify they are talking to the right person.
+    Prefer security_code_from_fingerprints with the stored MessageKey fingerprints.
+    
+    Args:
+        our_identity_key: Our identity public key in PEM format
+        their_identity_key: Their identity public key in PEM format
+        
+    Returns:
+        60-digit security code as a string, formatted in groups of 5 digits
+    """
+    return security_code_from_fingerprints(
+        identity_key_fingerprint(our_identity_key),
+        identity_key_fingerprint(their_identity_key)
+    )
+
+def generate_qr_verification_data(our_identity_key, their_identity_key, security_code=None):
     """
     Generate data for a QR code that can be scanned to verify identity keys,
     similar to WhatsApp's QR code verification.
+    Pass the already known security_code to avoid deriving it again.
     
     Returns a base64 encoded string that would be used to generate the QR code.
     """
+    if security_code is None:
+        security_code = generate_security_verification_code(our_identity_key, their_identity_key)
+    
     # Combination of both identity keys with additional verification data
     verification_data = {
         'type': 'contact_verification',
         'version': 1,
         'our_key': our_identity_key,
         'their_key': their_identity_key,
-        'security_code': generate_security_verification_code(our_identity_key, their_identity_key)
+        'security_code': security_code
     }
     
     # Convert to JSON and encode in base64
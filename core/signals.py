@@ -0,0 +1,59 @@
+"""
+Application signals
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import Signal
+
+from .consumers import chat_group_name, group_send_many, user_group_name
+from .models import Contact, UserProfile
+
+# Sent by core.prekeys when a user's unused one-time pre-keys drop to the low
+# watermark. Arguments: user, remaining.
+one_time_prekeys_low = Signal()
+
+
+def identity_key_saved(sender, instance, created, **kwargs):
+    """
+    Keep the profile fingerprint in sync and invalidate the security codes
+    (and their verification) of every contact pair involving a changed key
+    """
+    if not getattr(instance, 'fingerprint_changed', created):
+        return
+    
+    UserProfile.objects.filter(user_id=instance.user_id).update(identity_key_fingerprint=instance.fingerprint)
+    contacts = Contact.objects.filter(Q(owner_id=instance.user_id) | Q(contact_user_id=instance.user_id))
+    peer_ids = {
+        owner_id if owner_id != instance.user_id else contact_user_id
+        for owner_id, contact_user_id in contacts.values_list('owner_id', 'contact_user_id')
+    }
+    contacts.update(security_code=None, security_verified=False)
+    
+    # Open sockets cache the public keys; tell every conversation involving this user
+    groups = [user_group_name(instance.user_id)]
+    for peer_id in peer_ids:
+        groups += [user_group_name(peer_id), chat_group_name(instance.user_id, peer_id)]
+    notify_groups(groups, {'type': 'key_rotated', 'user_id': instance.user_id})
+
+
+def contact_deleted(sender, instance, **kwargs):
+    """
+    Revoke the owner's open sockets for a removed contact
+    """
+    notify_groups(
+        [user_group_name(instance.owner_id), chat_group_name(instance.owner_id, instance.contact_user_id)],
+        {'type': 'contact_removed', 'owner_id': instance.owner_id, 'contact_user_id': instance.contact_user_id}
+    )
+
+
+def notify_groups(groups, event):
+    """
+    Send a channel layer event to several groups once the transaction commits
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    transaction.on_commit(lambda: async_to_sync(group_send_many)(channel_layer, groups, event))
@@ -66,6 +66,52 @@ class EncryptionService {
         }
     }
 
+    /**
+     * Decrypt several messages in one request using the private key from localStorage
+     * 
+     * @param {string[]} encryptedMessages - The encrypted messages
+     * @returns {Promise<string[]>} - Decrypted messages (or per-item error messages), in the same order
+     */
+    async decryptMessages(encryptedMessages) {
+        if (!this.userId) {
+            return Promise.reject('Encryption service not initialized with user ID');
+        }
+
+        // Get the private key from localStorage
+        const privateKey = this.keyManager.getPrivateKey(this.userId);
+        if (!privateKey) {
+            return Promise.reject('Private key not found in local storage');
+        }
+
+        try {
+            // One round trip for the whole batch; the server parses the key once
+            const response = await fetch('/api/decrypt_messages/', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': this.getCsrfToken()
+                },
+                body: JSON.stringify({
+                    encrypted_messages: encryptedMessages,
+                    private_key: privateKey
+                })
+            });
+
+            const data = await response.json();
+            if (data.status === 'success') {
+                return data.results.map(result => result.status === 'success'
+                    ? result.decrypted_message
+                    : `🔒 Decryption failed: ${result.message}`);
+            } else {
+                console.error('Server decryption failed:', data.message);
+                return encryptedMessages.map(() => `🔒 Decryption failed: ${data.message}`);
+            }
+        } catch (error) {
+            console.error('Decryption error:', error);
+            return encryptedMessages.map(() => '🔒 Could not decrypt message');
+        }
+    }
+
     /**
      * Get CSRF token from the cookie
      * 
@@ -2,7 +2,18 @@ document.addEventListener('DOMContentLoaded', function() {
     // WebSocket connection
     let chatSocket = null;
     let messageQueue = [];
+    let pollingTimer = null;
+    let longPolling = false;
+    let pendingReadUpTo = 0;
+    let readReceiptTimer = null;
+    // Cursor for the page before the oldest message shown (null once we reach the start)
+    let olderCursor = document.getElementById('messageList')?.getAttribute('data-older-cursor') || null;
+    let loadingOlder = false;
+    // The contact has read our messages up to this id
+    let peerReadUpTo = parseInt(document.getElementById('messageList')?.getAttribute('data-read-up-to')) || 0;
     const selectedContact = document.querySelector('.contact-item.active');
+    // The conversation shown in the chat section; frames for others only update badges
+    let currentContactId = selectedContact ? selectedContact.getAttribute('data-contact-id') : null;
     
     // Initialize encryption services
     const userId = document.querySelector('meta[name="user-id"]')?.content;
@@ -89,6 +100,18 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
+        const emptyState = messageList.querySelector('.empty-state');
+        if (emptyState) {
+            emptyState.remove();
+        }
+        
+        messageList.appendChild(createMessageItem(content, isSent, timestamp, messageId));
+        
+        // Scroll to bottom
+        scrollToBottom();
+    }
+    
+    function createMessageItem(content, isSent, timestamp, messageId = null) {
         const messageItem = document.createElement('div');
         messageItem.className = `message-item ${isSent ? 'sent' : 'received'}`;
         if (messageId) {
@@ -122,23 +145,11 @@ document.addEventListener('DOMContentLoaded', function() {
             messageTime.appendChild(statusSpan);
         } else {
             messageTime.textContent = formattedTime;
-            
-            // Mark this message as read if we're the receiver
-            if (chatSocket && chatSocket.readyState === WebSocket.OPEN && messageId) {
-                chatSocket.send(JSON.stringify({
-                    'type': 'read_receipt',
-                    'message_id': messageId
-                }));
-            }
         }
         
         messageItem.appendChild(messageContent);
         messageItem.appendChild(messageTime);
-        
-        messageList.appendChild(messageItem);
-        
-        // Scroll to bottom
-        scrollToBottom();
+        return messageItem;
     }
     
     // Function to format timestamp
@@ -164,11 +175,87 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initial scroll to bottom
     scrollToBottom();
     
-    // Setup WebSocket connection if a contact is selected
-    if (selectedContact) {
-        const contactId = selectedContact.getAttribute('data-contact-id');
+    // Unread badges in the contact list
+    function setUnreadBadge(contactItem, count) {
+        let badge = contactItem.querySelector('.unread-badge');
+        if (count <= 0) {
+            if (badge) badge.remove();
+            return;
+        }
+        if (!badge) {
+            badge = document.createElement('div');
+            badge.className = 'unread-badge';
+            contactItem.querySelector('.contact-info').appendChild(badge);
+        }
+        badge.textContent = count;
+    }
+    
+    function incrementUnreadBadge(contactId) {
+        const contactItem = document.querySelector(`.contact-item[data-contact-id="${contactId}"]`);
+        if (!contactItem) return;
+        const badge = contactItem.querySelector('.unread-badge');
+        setUnreadBadge(contactItem, (badge ? parseInt(badge.textContent) || 0 : 0) + 1);
+    }
+    
+    // The contact has read all of our messages up to upTo
+    function markMessagesReadUpTo(upTo) {
+        peerReadUpTo = Math.max(peerReadUpTo, upTo);
+        document.querySelectorAll('.message-item.sent[data-message-id]').forEach(messageItem => {
+            if (parseInt(messageItem.getAttribute('data-message-id')) > upTo) return;
+            const statusSpan = messageItem.querySelector('.message-status');
+            if (statusSpan) {
+                statusSpan.innerHTML = ' <i class="fas fa-check-double"></i>'; // Double checkmark for read
+            }
+        });
+    }
+    
+    // Tell the server we've read up to a message; bursts collapse into one receipt
+    function scheduleReadReceipt(messageId) {
+        pendingReadUpTo = Math.max(pendingReadUpTo, messageId);
+        if (readReceiptTimer) return;
+        readReceiptTimer = setTimeout(function() {
+            readReceiptTimer = null;
+            if (chatSocket && chatSocket.readyState === WebSocket.OPEN && pendingReadUpTo) {
+                chatSocket.send(JSON.stringify({
+                    'type': 'read_receipt',
+                    'contact_id': currentContactId,
+                    'up_to': pendingReadUpTo
+                }));
+            }
+            pendingReadUpTo = 0;
+        }, 250);
+    }
+    
+    // Route a frame from the user socket to its conversation
+    function handleSocketFrame(data) {
+        const contactId = String(data.contact_id);
         
-        // Try to establish WebSocket connection - fixed URL for Replit
+        if (data.type === 'chat_message') {
+            const isSent = data.sender_id === parseInt(userId);
+            
+            if (contactId === currentContactId) {
+                // Add message to UI
+                addMessageToUI(data.message, isSent, new Date(data.timestamp), data.message_id);
+                
+                // Mark it as read since the conversation is open
+                if (!isSent) {
+                    scheduleReadReceipt(data.message_id);
+                }
+            } else if (!isSent) {
+                // A conversation that isn't open: just count it
+                incrementUnreadBadge(contactId);
+            }
+        } 
+        else if (data.type === 'read_receipt') {
+            // Update message status to read (double checkmark)
+            if (contactId === currentContactId && data.reader_id !== parseInt(userId)) {
+                markMessagesReadUpTo(data.up_to);
+            }
+        }
+    }
+    
+    // One WebSocket per page for all conversations
+    function connectUserSocket() {
         try {
             // Create WebSocket connection - with error handling for ngrok
             const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
@@ -181,7 +268,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 console.log('Detected ngrok domain, using special WebSocket handling');
             }
             
-            const wsUrl = `${protocol}//${host}/ws/chat/${contactId}/`;
+            const wsUrl = `${protocol}//${host}/ws/user/`;
             console.log(`Attempting to connect to WebSocket at: ${wsUrl}`);
             chatSocket = new WebSocket(wsUrl);
             
@@ -197,51 +284,51 @@ document.addEventListener('DOMContentLoaded', function() {
             
             chatSocket.onmessage = function(e) {
                 console.log('WebSocket message received:', e.data);
-                const data = JSON.parse(e.data);
-                
-                if (data.type === 'chat_message') {
-                    // Check if message is from current user or contact
-                    const isSent = data.sender_id === parseInt(document.querySelector('meta[name="user-id"]').content);
-                    
-                    // Add message to UI
-                    addMessageToUI(data.message, isSent, new Date(data.timestamp), data.message_id);
-                } 
-                else if (data.type === 'read_receipt') {
-                    // Update message status to read (double checkmark)
-                    const messageId = data.message_id;
-                    const messageItem = document.querySelector(`.message-item[data-message-id="${messageId}"]`);
-                    
-                    if (messageItem) {
-                        const statusSpan = messageItem.querySelector('.message-status');
-                        if (statusSpan) {
-                            statusSpan.innerHTML = ' <i class="fas fa-check-double"></i>'; // Double checkmark for read
-                        }
-                    }
-                }
+                handleSocketFrame(JSON.parse(e.data));
             };
             
             chatSocket.onclose = function(e) {
                 console.log('WebSocket connection closed');
+                
+                // The server closes with 4429 when we fell too far behind;
+                // reconnect after the hinted delay and reload what we missed
+                if (e.code === 4429) {
+                    let retryAfter = 5;
+                    try {
+                        retryAfter = JSON.parse(e.reason).retry_after || retryAfter;
+                    } catch (error) {}
+                    setTimeout(function() {
+                        connectUserSocket();
+                        if (currentContactId) {
+                            loadInitialMessages(currentContactId);
+                        }
+                    }, retryAfter * 1000);
+                    return;
+                }
+                
                 // Fallback to polling when WebSocket is closed
-                initPolling(contactId);
+                initPolling();
             };
             
             chatSocket.onerror = function(e) {
                 console.error('WebSocket error:', e);
                 // Fallback to polling if WebSocket fails
-                initPolling(contactId);
+                initPolling();
             };
         } catch (error) {
             console.error('Failed to establish WebSocket connection:', error);
             // Fallback to polling if WebSocket setup fails
-            initPolling(contactId);
+            initPolling();
         }
     }
     
+    if (userId) {
+        connectUserSocket();
+    }
+    
     // Load initial messages for the selected contact
     if (selectedContact) {
-        const contactId = selectedContact.getAttribute('data-contact-id');
-        loadInitialMessages(contactId);
+        loadInitialMessages(currentContactId);
     }
     
     async function loadInitialMessages(contactId) {
@@ -258,7 +345,12 @@ document.addEventListener('DOMContentLoaded', function() {
             if (data.status === 'success') {
                 // Process and decrypt messages
                 const decryptedMessages = await processMessages(data.messages);
-                updateMessages(decryptedMessages);
+                // Drop the result if the user has switched conversations meanwhile
+                if (contactId === currentContactId) {
+                    olderCursor = data.next_cursor;
+                    updateMessages(decryptedMessages);
+                    markMessagesReadUpTo(data.read_up_to);
+                }
             } else {
                 console.error('Error loading messages:', data.message);
             }
@@ -267,6 +359,51 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // Prepend the page before the oldest message shown, keeping the scroll position
+    async function loadOlderMessages() {
+        if (!currentContactId || !olderCursor || loadingOlder) return;
+        const contactId = currentContactId;
+        loadingOlder = true;
+        
+        try {
+            const response = await fetch(`/api/get-messages/${contactId}/?cursor=${encodeURIComponent(olderCursor)}`);
+            const data = await response.json();
+            if (data.status === 'success' && contactId === currentContactId) {
+                const decryptedMessages = await processMessages(data.messages);
+                if (contactId !== currentContactId) return;
+                
+                const messageList = document.getElementById('messageList');
+                const firstItem = messageList.firstChild;
+                const previousHeight = messageList.scrollHeight;
+                decryptedMessages.forEach(msg => {
+                    if (document.querySelector(`.message-item[data-message-id="${msg.id}"]`)) return;
+                    messageList.insertBefore(createMessageItem(msg.content, msg.is_self, msg.sent_on, msg.id), firstItem);
+                    if (msg.is_self && msg.is_read) {
+                        markMessagesReadUpTo(msg.id);
+                    }
+                });
+                messageList.scrollTop += messageList.scrollHeight - previousHeight;
+                olderCursor = data.next_cursor;
+            } else if (data.status !== 'success') {
+                console.error('Error loading older messages:', data.message);
+            }
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            loadingOlder = false;
+        }
+    }
+    
+    // Scrolling to the top of the conversation loads the page before it
+    const scrollableList = document.getElementById('messageList');
+    if (scrollableList) {
+        scrollableList.addEventListener('scroll', function() {
+            if (scrollableList.scrollTop < 50) {
+                loadOlderMessages();
+            }
+        });
+    }
+    
     // Process and decrypt messages using client-side key
     async function processMessages(messages) {
         // Ensure we have a valid private key
@@ -283,54 +420,95 @@ document.addEventListener('DOMContentLoaded', function() {
             return messages;
         }
         
-        // Process each message
-        const processedMessages = [];
-        for (const msg of messages) {
-            try {
-                // Try to decrypt the message content
-                if (msg.encrypted_content) {
-                    const decryptedContent = await encryptionService.decryptMessage(
-                        msg.encrypted_content, 
-                        privateKey
-                    );
-                    msg.content = decryptedContent || msg.content;
-                }
-            } catch (error) {
-                console.error('Failed to decrypt message:', error);
-            }
-            processedMessages.push(msg);
+        // Decrypt all messages in a single batch request
+        const encrypted = messages.filter(msg => msg.encrypted_content);
+        try {
+            const decryptedContents = await encryptionService.decryptMessages(
+                encrypted.map(msg => msg.encrypted_content)
+            );
+            encrypted.forEach((msg, i) => {
+                msg.content = decryptedContents[i] || msg.content;
+            });
+        } catch (error) {
+            console.error('Failed to decrypt messages:', error);
         }
         
-        return processedMessages;
+        return messages;
     }
     
-    // Fallback polling function in case WebSockets fail
-    function initPolling(contactId) {
-        console.log('Falling back to polling for messages');
+    // Ask only for what changed since the newest message and receipt we have;
+    // the server answers 304 when nothing did
+    async function pollMessages() {
+        if (!currentContactId) return;
+        const contactId = currentContactId;
+        let params = new URLSearchParams({after: latestMessageId(), read_up_to: peerReadUpTo});
         
-        async function pollMessages() {
-            const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]').value;
+        try {
+            while (params && contactId === currentContactId) {
+                const response = await fetch(`/api/get-messages/${contactId}/?${params}`, {cache: 'no-store'});
+                if (response.status === 304) return;
+                
+                const data = await response.json();
+                if (data.status !== 'success') return;
+                // Process and decrypt messages
+                const decryptedMessages = await processMessages(data.messages);
+                if (contactId !== currentContactId) return;
+                mergeMessages(decryptedMessages);
+                markMessagesReadUpTo(data.read_up_to);
+                // More than a page arrived: keep going forwards
+                params = data.next_cursor ? new URLSearchParams({cursor: data.next_cursor}) : null;
+            }
+        } catch (error) {
+            console.error('Error polling messages:', error);
+        }
+    }
+    
+    function delay(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+    
+    // Wait on the server for the next event in the open conversation; it
+    // answers as soon as one arrives, or with no events after a timeout
+    async function longPoll() {
+        while (longPolling) {
+            const contactId = currentContactId;
+            if (!contactId) {
+                await delay(5000);
+                continue;
+            }
             
             try {
-                const response = await fetch(`/api/get-messages/${contactId}/`, {
-                    headers: {
-                        'X-CSRFToken': csrfToken,
-                    }
-                });
+                const params = new URLSearchParams({after: latestMessageId(), read_up_to: peerReadUpTo});
+                const response = await fetch(`/api/poll-messages/${contactId}/?${params}`, {cache: 'no-store'});
+                if (response.status === 503) {
+                    // The server can't long poll: fall back to asking every few seconds
+                    longPolling = false;
+                    pollingTimer = setInterval(pollMessages, 5000);
+                    return;
+                }
                 
                 const data = await response.json();
-                if (data.status === 'success') {
-                    // Process and decrypt messages
-                    const decryptedMessages = await processMessages(data.messages);
-                    updateMessages(decryptedMessages);
+                if (data.status !== 'success') throw new Error(data.message);
+                if (contactId !== currentContactId) continue;
+                // We missed something between polls: catch up first
+                if (data.stale) {
+                    await pollMessages();
                 }
+                data.events.forEach(handleSocketFrame);
             } catch (error) {
-                console.error('Error polling messages:', error);
+                console.error('Error long polling messages:', error);
+                await delay(5000);
             }
         }
-        
-        // Start polling
-        setInterval(pollMessages, 5000);
+    }
+    
+    // Fallback in case WebSockets fail
+    function initPolling() {
+        // onerror and onclose both fire for a failed socket
+        if (pollingTimer || longPolling) return;
+        console.log('Falling back to long polling for messages');
+        longPolling = true;
+        longPoll();
     }
     
     // Update the UI with the latest messages
@@ -357,18 +535,31 @@ document.addEventListener('DOMContentLoaded', function() {
                 
                 // If message is sent by current user and is read, show double check mark
                 if (msg.is_self && msg.is_read) {
-                    const messageItem = document.querySelector(`.message-item[data-message-id="${msg.id}"]`);
-                    if (messageItem) {
-                        const statusSpan = messageItem.querySelector('.message-status');
-                        if (statusSpan) {
-                            statusSpan.innerHTML = ' <i class="fas fa-check-double"></i>'; // Double checkmark for read
-                        }
-                    }
+                    markMessagesReadUpTo(msg.id);
                 }
             });
         }
     }
     
+    // The id of the newest message shown (0 if none)
+    function latestMessageId() {
+        let latest = 0;
+        document.querySelectorAll('.message-item[data-message-id]').forEach(messageItem => {
+            latest = Math.max(latest, parseInt(messageItem.getAttribute('data-message-id')) || 0);
+        });
+        return latest;
+    }
+    
+    // Add any polled messages that aren't shown yet, keeping what is already there
+    function mergeMessages(messages) {
+        messages.forEach(msg => {
+            addMessageToUI(msg.content, msg.is_self, msg.sent_on, msg.id);
+            if (msg.is_self && msg.is_read) {
+                markMessagesReadUpTo(msg.id);
+            }
+        });
+    }
+    
     // Message form submission
     const messageForm = document.getElementById('messageForm');
     if (messageForm) {
@@ -384,6 +575,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
                 chatSocket.send(JSON.stringify({
                     'type': 'chat_message',
+                    'contact_id': currentContactId,
                     'message': content
                 }));
                 
@@ -394,6 +586,7 @@ document.addEventListener('DOMContentLoaded', function() {
             else if (chatSocket) {
                 const message = JSON.stringify({
                     'type': 'chat_message',
+                    'contact_id': currentContactId,
                     'message': content
                 });
                 
@@ -435,7 +628,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 messageForm.reset();
                 
                 // Add message to the UI
-                addMessageToUI(content, true, new Date());
+                addMessageToUI(content, true, new Date(), data.message_id);
             } else {
                 console.error('Error sending message:', data.message);
                 alert('Failed to send message: ' + data.message);
@@ -483,8 +676,55 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
             }
             
-            // Navigate to the contact's messages
-            window.location.href = `/messages/?contact=${contactId}`;
+            // Switch in place when the chat section is already on the page
+            if (!switchConversation(this)) {
+                // Navigate to the contact's messages
+                window.location.href = `/messages/?contact=${contactId}`;
+            }
         });
     });
+    
+    // Show another conversation without reloading the page (and its socket)
+    function switchConversation(contactItem) {
+        const contactId = contactItem.getAttribute('data-contact-id');
+        const chatHeader = document.querySelector('.chat-header');
+        if (!chatHeader || !messageForm) return false;
+        if (contactId === currentContactId) return true;
+        
+        currentContactId = contactId;
+        pendingReadUpTo = 0;
+        olderCursor = null;
+        peerReadUpTo = 0;
+        contactItems.forEach(item => item.classList.toggle('active', item === contactItem));
+        // Opening the conversation marks its messages as read
+        setUnreadBadge(contactItem, 0);
+        
+        chatHeader.querySelector('h5').textContent = contactItem.getAttribute('data-username');
+        const verified = contactItem.getAttribute('data-security-verified') === 'true';
+        const securityArea = chatHeader.querySelector('.ms-auto');
+        if (securityArea) {
+            securityArea.innerHTML = `
+                <span class="me-2" title="${verified ? 'Security verified' : 'Security not verified'}">
+                    <i class="fas fa-shield-alt ${verified ? 'text-success' : 'text-warning'}"></i>
+                </span>
+                <a class="btn btn-sm btn-outline-primary"></a>
+            `;
+            const securityLink = securityArea.querySelector('a');
+            securityLink.href = contactItem.getAttribute('data-security-url');
+            securityLink.textContent = verified ? 'Security Verified' : 'Verify Security';
+        }
+        
+        messageForm.reset();
+        messageForm.querySelector('[name="receiver_id"]').value = contactId;
+        document.getElementById('messageList').innerHTML = '';
+        
+        history.pushState({contact: contactId}, '', `/messages/?contact=${contactId}`);
+        loadInitialMessages(contactId);
+        return true;
+    }
+    
+    // Back/forward between switched conversations: let the server render it
+    window.addEventListener('popstate', function() {
+        window.location.reload();
+    });
 });
\ No newline at end of file
@@ -18,5 +18,11 @@ urlpatterns = [
     # API endpoints
     path('api/send-message/', views.send_message, name='send_message'),
     path('api/get-messages/<int:contact_id>/', views.get_messages, name='get_messages'),
+    path('api/poll-messages/<int:contact_id>/', views.poll_messages, name='poll_messages'),
     path('api/decrypt_message/', views.decrypt_message_api, name='decrypt_message_api'),
+    path('api/decrypt_messages/', views.decrypt_messages_api, name='decrypt_messages_api'),
+    path('api/prekeys/', views.prekey_status, name='prekey_status'),
+    path('api/prekeys/replenish/', views.replenish_prekeys, name='replenish_prekeys'),
+    path('api/prekeys/claim/<int:contact_id>/', views.claim_prekey, name='claim_prekey'),
+    path('api/metrics/', views.metrics_view, name='metrics_view'),
 ]
@@ -1,17 +1,120 @@
-from .models import Contact, Message
-from django.db.models import Q, Count, Max, F, ExpressionWrapper, DateTimeField
-from django.db.models.functions import Greatest
+import base64
+import binascii
+
+from django.conf import settings
+
+from .models import Contact, Message, ReadWatermark
+from django.db.models import Q, Count, Max, F, ExpressionWrapper, DateTimeField, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
 
 def get_contacts_with_unread_count(user):
     """
     Get all contacts of a user with the number of unread messages from each contact
     """
+    # A correlated count, so each contact is one range of core_msg_unread_idx
+    # (sender, receiver, id > watermark) rather than all of their sent messages
+    unread = Message.objects.filter(
+        sender=OuterRef('contact_user'), receiver=user, id__gt=OuterRef('read_up_to')
+    ).order_by().values('sender').annotate(count=Count('id')).values('count')
     return Contact.objects.filter(owner=user).select_related('contact_user').annotate(
-        unread_count=Count(
-            'contact_user__sent_messages',
-            filter=Q(contact_user__sent_messages__receiver=user, contact_user__sent_messages__is_read=False)
-        )
+        read_up_to=Coalesce(Subquery(read_watermarks(user)), 0),
+    ).annotate(
+        unread_count=Coalesce(Subquery(unread), 0)
+    )
+
+def read_watermarks(user):
+    """
+    The user's watermark for the contact_user of an outer Contact query
+    """
+    return ReadWatermark.objects.filter(
+        reader=user, peer=OuterRef('contact_user')
+    ).values('last_read_message_id')[:1]
+
+def conversation_contact(user, contact_id):
+    """
+    The user's Contact for contact_id (with contact_user loaded), or None
+    Also annotates the conversation's sync state in the same query:
+    latest_message_id, read_up_to (the user's watermark) and
+    contact_read_up_to (the contact's), each 0 when there is none.
+    """
+    latest = Message.objects.filter(
+        conversation_key=Message.conversation_key_for(user.id, contact_id)
+    ).order_by('-id').values('id')[:1]
+    contacts = Contact.objects.filter(owner=user, contact_user_id=contact_id).select_related('contact_user').annotate(
+        latest_message_id=Coalesce(Subquery(latest), 0),
+        read_up_to=Coalesce(Subquery(read_watermarks(user)), 0),
+        contact_read_up_to=Coalesce(Subquery(ReadWatermark.objects.filter(
+            reader=OuterRef('contact_user'), peer=user
+        ).values('last_read_message_id')[:1]), 0),
     )
+    # get() rather than first(): (owner, contact_user) is unique, and first() would add a sort
+    try:
+        return contacts.get()
+    except Contact.DoesNotExist:
+        return None
+
+def read_positions(user, contact):
+    """
+    Return (user_read_up_to, contact_read_up_to) for one conversation in a single query
+    """
+    positions = {reader_id: last_read for reader_id, last_read in ReadWatermark.objects.filter(
+        Q(reader=user, peer=contact) | Q(reader=contact, peer=user)
+    ).values_list('reader_id', 'last_read_message_id')}
+    return positions.get(user.id, 0), positions.get(contact.id, 0)
+
+# Cursor directions: 'b' pages back through older messages, 'a' forward through newer ones
+CURSOR_DIRECTIONS = {'before': 'b', 'after': 'a'}
+
+def encode_cursor(direction, message_id):
+    """
+    Opaque cursor for continuing a page in the given direction ('before' or 'after')
+    """
+    raw = f'{CURSOR_DIRECTIONS[direction]}:{int(message_id)}'.encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Return (direction, message_id) for a cursor from encode_cursor
+    Raises ValueError if it isn't one.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        code, message_id = raw.split(':')
+        direction = {code: name for name, code in CURSOR_DIRECTIONS.items()}[code]
+        message_id = int(message_id)
+    except (binascii.Error, UnicodeError, ValueError, KeyError):
+        raise ValueError("Invalid cursor")
+    if message_id < 0:
+        raise ValueError("Invalid cursor")
+    return direction, message_id
+
+def conversation_page(user, contact, before=None, after=None, limit=None, fields=None):
+    """
+    One page of the conversation between two users, oldest first
+    The newest messages by default, otherwise those just older than `before`
+    or just newer than `after` (message ids). Each page is one range scan of
+    the (conversation_key, id) index. Returns (messages, has_more), where
+    has_more says whether the conversation continues past the page in the
+    direction being read. With `fields`, messages are dicts of those values.
+    """
+    limit = limit or getattr(settings, 'MESSAGE_PAGE_SIZE', 50)
+    messages = Message.objects.filter(conversation_key=Message.conversation_key_for(user.id, contact.id))
+    if after is not None:
+        messages = messages.filter(id__gt=after).order_by('id')
+    else:
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        messages = messages.order_by('-id')
+    if fields:
+        messages = messages.values(*fields)
+    
+    # One row past the page tells us whether there is another
+    page = list(messages[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    if after is None:
+        page.reverse()
+    return page, has_more
 
 def get_contact_with_last_message(user):
     """
@@ -23,9 +126,8 @@ def get_contact_with_last_message(user):
     for contact in contacts:
         # Get the most recent message between the user and this contact
         last_message = Message.objects.filter(
-            (Q(sender=user) & Q(receiver=contact.contact_user)) | 
-            (Q(sender=contact.contact_user) & Q(receiver=user))
-        ).order_by('-sent_on').first()
+            conversation_key=Message.conversation_key_for(user.id, contact.contact_user_id)
+        ).order_by('-id').first()
         
         result.append({
             'contact': contact,
@@ -33,4 +135,5 @@ def get_contact_with_last_message(user):
         })
     
     # Sort by last message time, most recent first
-    return sorted(result, key=lambda x: x['last_message'].sent_on if x['last_message'] else 0, reverse=True)
+    # Ids follow sending order, and unlike sent_on compare with the 0 for no messages
+    return sorted(result, key=lambda x: x['last_message'].id if x['last_message'] else 0, reverse=True)
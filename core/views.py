@@ -3,17 +3,79 @@ from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate, logout
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponseForbidden, HttpResponseNotModified
 from django.views.decorators.http import require_POST
-from django.db.models import Q
-from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+import asyncio
 import json
+import time
 
-from .models import UserProfile, Contact, Message, MessageKey
+from .models import UserProfile, Contact, Message, MessageKey, ReadWatermark, SignedPreKey
 from .forms import UserRegistrationForm, UserLoginForm, CalculatorPasswordForm, ContactForm, MessageForm
-from .encryption import generate_key_pair, encrypt_message, decrypt_message
+from .encryption import encrypt_message_frame, decrypt_message, decrypt_messages
+from .executors import crypto_executor
+from .consumers import broadcast_conversation_event, chat_group_name
+from .key_pool import key_pool
+from .metrics import metrics
+from . import prekeys
+from .signal_protocol import base64_encode
+from .utils import (
+    conversation_contact, conversation_page, decode_cursor, encode_cursor, get_contacts_with_unread_count,
+    read_positions
+)
 
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
+from django.conf import settings
+
+def broadcast(user_id, contact_id, event):
+    """
+    Push a conversation event to both participants' open sockets
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        async_to_sync(broadcast_conversation_event)(channel_layer, user_id, contact_id, event)
+
+def page_request(params):
+    """
+    Parse before/after/cursor/limit query parameters into (before, after, limit)
+    Raises ValueError with a message for the client if they are invalid.
+    """
+    max_limit = getattr(settings, 'MESSAGE_PAGE_SIZE_MAX', 200)
+    try:
+        limit = int(params.get('limit') or getattr(settings, 'MESSAGE_PAGE_SIZE', 50))
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if not 0 < limit <= max_limit:
+        raise ValueError(f'Limit must be between 1 and {max_limit}')
+    
+    positions = {}
+    if params.get('cursor'):
+        direction, message_id = decode_cursor(params['cursor'])
+        positions[direction] = message_id
+    for direction in ('before', 'after'):
+        if params.get(direction):
+            try:
+                positions[direction] = int(params[direction])
+            except ValueError:
+                raise ValueError(f'Invalid {direction}')
+    if len(positions) > 1:
+        raise ValueError('Use only one of before, after and cursor')
+    return positions.get('before'), positions.get('after'), limit
+
+def mark_conversation_read(user, contact, latest_incoming_id, read_up_to):
+    """
+    Move the user's read watermark up to the newest message shown from contact
+    Nothing is written when there is nothing new, so polling stays read-only.
+    """
+    if latest_incoming_id > read_up_to and ReadWatermark.advance(user.id, contact.id, latest_incoming_id):
+        broadcast(user.id, contact.id, {
+            'type': 'read_receipt',
+            'up_to': latest_incoming_id,
+            'reader_id': user.id,
+            'sender_id': contact.id,
+        })
 
 @ensure_csrf_cookie
 def calculator_view(request):
@@ -63,8 +125,8 @@ def register_view(request):
                 calculator_password=calculator_password_form.cleaned_data['calculator_password']
             )
             
-            # Generate encryption keys
-            public_key, private_key = generate_key_pair()
+            # Take pre-generated encryption keys from the pool (generated inline if it's empty)
+            public_key, private_key = key_pool.take()
             
             # Only save the public key to the database
             MessageKey.objects.create(
@@ -83,6 +145,9 @@ def register_view(request):
     else:
         form = UserRegistrationForm()
         calculator_password_form = CalculatorPasswordForm()
+        
+        # Someone is about to sign up, make sure key pairs are being prepared
+        key_pool.warm()
     
     return render(request, 'core/register.html', {
         'form': form,
@@ -132,14 +197,16 @@ def messages_view(request):
     if not request.session.get('calculator_verified', False):
         return redirect('calculator_view')
     
-    # Get user's contacts
-    contacts = Contact.objects.filter(owner=request.user).select_related('contact_user')
+    # Get user's contacts with their unread counts for the sidebar
+    contacts = get_contacts_with_unread_count(request.user)
     
     # Get selected contact if any
     selected_contact_id = request.GET.get('contact')
     selected_contact = None
     selected_contact_obj = None  # The Contact object (not User) for security verification
     messages_list = []
+    peer_read_up_to = 0  # Our messages up to this id have been read by the contact
+    older_cursor = None  # Set when the conversation has messages before the first page
     
     if selected_contact_id:
         try:
@@ -152,18 +219,17 @@ def messages_view(request):
             else:
                 selected_contact_obj = contact_obj
                 
-                # Get messages between users
-                messages_list = Message.objects.filter(
-                    (Q(sender=request.user) & Q(receiver=selected_contact)) | 
-                    (Q(sender=selected_contact) & Q(receiver=request.user))
-                ).order_by('sent_on')
+                # Only the newest page; older ones are fetched as the user scrolls up
+                messages_list, has_older = conversation_page(request.user, selected_contact)
+                if has_older:
+                    older_cursor = encode_cursor('before', messages_list[0].id)
                 
-                # Mark unread messages as read
-                Message.objects.filter(
-                    sender=selected_contact,
-                    receiver=request.user,
-                    is_read=False
-                ).update(is_read=True)
+                # Mark everything shown as read
+                read_up_to, peer_read_up_to = read_positions(request.user, selected_contact)
+                latest_incoming_id = max(
+                    (msg.id for msg in messages_list if msg.sender_id == selected_contact.id), default=0
+                )
+                mark_conversation_read(request.user, selected_contact, latest_incoming_id, read_up_to)
         except User.DoesNotExist:
             pass
     
@@ -171,7 +237,10 @@ def messages_view(request):
         'contacts': contacts,
         'selected_contact': selected_contact,
         'selected_contact_obj': selected_contact_obj,  # Pass the Contact object for security verification
-        'messages': messages_list,
+        # Not 'messages': base.html renders that as django.contrib.messages alerts
+        'chat_messages': messages_list,
+        'peer_read_up_to': peer_read_up_to,
+        'older_cursor': older_cursor,
         'form': MessageForm() if selected_contact else None
     })
 
@@ -262,35 +331,32 @@ def send_message(request):
                 # Get receiver's public key
                 try:
                     receiver_key = MessageKey.objects.get(user=receiver)
-                    # Encrypt the message with receiver's public key
-                    encrypted_content = encrypt_message(content, receiver_key.public_key)
+                    recipients = {receiver.id: receiver_key.load_public_key()}
+                    
+                    # Also wrap the content key for ourselves so we can read our own message later
+                    own_key = MessageKey.objects.filter(user=request.user).first()
+                    if own_key:
+                        recipients[request.user.id] = own_key.load_public_key()
+                    
+                    # Encrypt the message once for both participants
+                    payload = encrypt_message_frame(content, recipients)
                     
                     # Save the encrypted message
                     message = Message.objects.create(
                         sender=request.user,
                         receiver=receiver,
-                        content=encrypted_content,
-                        is_read=False
+                        payload=payload
                     )
                     
-                    # IMPROVEMENT: For better user experience, also save a special copy for self
-                    # Get our own public key
-                    try:
-                        own_key = MessageKey.objects.get(user=request.user)
-                        # Encrypt with our own public key so we can decrypt it later
-                        self_encrypted = encrypt_message(content, own_key.public_key)
-                        
-                        # Save a special "sent to self" message that we can decrypt later
-                        Message.objects.create(
-                            sender=receiver,  # Trick: mark it as if it came from receiver
-                            receiver=request.user,  # To self
-                            content=self_encrypted,
-                            is_read=True,  # Already read
-                            sent_on=message.sent_on  # Same timestamp to match
-                        )
-                    except MessageKey.DoesNotExist:
-                        # Not critical if this fails, user will still see encrypted message
-                        pass
+                    # Push it to both participants' open sockets
+                    broadcast(request.user.id, receiver.id, {
+                        'type': 'chat_message',
+                        'message': content,
+                        'sender_id': request.user.id,
+                        'receiver_id': receiver.id,
+                        'message_id': message.id,
+                        'timestamp': message.sent_on.isoformat(),
+                    })
                     
                     return JsonResponse({
                         'status': 'success',
@@ -308,75 +374,198 @@ def send_message(request):
 @login_required
 def get_messages(request, contact_id):
     """
-    API endpoint to get messages with a specific contact
+    API endpoint to get one page of messages with a specific contact
+    The newest page by default; `before` or `after` (message ids) or the
+    `cursor` from a previous response page through the rest, and `limit`
+    sets the page size. Runs a fixed number of queries however long the
+    conversation is (see the check_queries management command).
+    
+    Delta sync: a poller sends `after` (the newest message it has) and
+    `read_up_to` (the contact's read watermark it last saw) and gets only
+    newer messages plus the current watermark, or a 304 if neither moved.
+    Responses also carry an ETag of the conversation state for If-None-Match.
     """
     # Check if user is verified through calculator
     if not request.session.get('calculator_verified', False):
         return HttpResponseForbidden()
     
     try:
-        contact = User.objects.get(id=contact_id)
+        before, after, limit = page_request(request.GET)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    try:
+        seen_read_up_to = int(request.GET['read_up_to']) if request.GET.get('read_up_to') else None
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid read_up_to'}, status=400)
+    
+    # Check this is a valid contact, loading the contact user and the
+    # conversation's latest message id and read watermarks with it
+    contact_obj = conversation_contact(request.user, contact_id)
+    if contact_obj is None:
+        if not User.objects.filter(id=contact_id).exists():
+            return JsonResponse({'status': 'error', 'message': 'User does not exist'})
+        return JsonResponse({'status': 'error', 'message': 'Invalid contact'})
+    contact = contact_obj.contact_user
+    read_up_to, contact_read_up_to = contact_obj.read_up_to, contact_obj.contact_read_up_to
+    
+    # Nothing new: an idle poll ends here, after that one indexed lookup
+    etag = quote_etag(f'{contact_obj.latest_message_id}.{contact_read_up_to}')
+    unchanged = (
+        after is not None and seen_read_up_to is not None
+        and contact_obj.latest_message_id <= after and contact_read_up_to <= seen_read_up_to
+    )
+    if unchanged or etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    
+    # Private keys are stored client-side; we only need to know there is a key
+    if not MessageKey.objects.filter(user=request.user).exists():
+        return JsonResponse({'status': 'error', 'message': 'You have no encryption key'})
+    
+    rows, has_more = conversation_page(
+        request.user, contact, before=before, after=after, limit=limit,
+        fields=('id', 'sent_on', *Message.CIPHERTEXT_FIELDS)
+    )
+    
+    # Every message is from one of the two participants, so no join is needed
+    usernames = {request.user.id: request.user.username, contact.id: contact.username}
+    messages_data = []
+    latest_incoming_id = 0
+    for row in rows:
+        is_self = row['sender_id'] == request.user.id
+        if not is_self:
+            latest_incoming_id = max(latest_incoming_id, row['id'])
         
-        # Check if this is a valid contact
-        is_contact = Contact.objects.filter(owner=request.user, contact_user=contact).exists()
-        if not is_contact:
+        messages_data.append({
+            'id': row['id'],
+            # Placeholder content (will be decrypted client-side)
+            'content': "🔒 Encrypted message",
+            # Return encrypted content for client-side decryption
+            'encrypted_content': Message.row_ciphertext(row, request.user.id),
+            'sent_on': row['sent_on'].strftime('%Y-%m-%d %H:%M:%S'),
+            'sender': usernames[row['sender_id']],
+            'is_self': is_self,
+            # Ours: has the contact read it; theirs: read now that it was fetched
+            'is_read': row['id'] <= contact_read_up_to if is_self else True
+        })
+    
+    # Mark everything returned as read
+    mark_conversation_read(request.user, contact, latest_incoming_id, read_up_to)
+    
+    # Continue in the direction being read: older pages backwards, newer ones forwards
+    next_cursor = None
+    if has_more and after is not None:
+        next_cursor = encode_cursor('after', rows[-1]['id'])
+    elif has_more:
+        next_cursor = encode_cursor('before', rows[0]['id'])
+    
+    response = JsonResponse({
+        'status': 'success',
+        'messages': messages_data,
+        'next_cursor': next_cursor,
+        # The contact has read our messages up to here, including ones not in this page
+        'read_up_to': contact_read_up_to,
+    })
+    response['ETag'] = etag
+    return response
+
+def long_poll_frame(event, contact_id):
+    """
+    The frame a per-user socket would get for a conversation event, or None
+    for events long-poll clients don't need
+    """
+    if event['type'] == 'chat_message':
+        return {
+            'type': 'chat_message',
+            'contact_id': contact_id,
+            'message': event['message'],
+            'sender_id': event['sender_id'],
+            'message_id': event['message_id'],
+            'timestamp': event['timestamp'],
+        }
+    if event['type'] == 'read_receipt':
+        return {
+            'type': 'read_receipt',
+            'contact_id': contact_id,
+            'up_to': event['up_to'],
+            'reader_id': event['reader_id'],
+        }
+    return None
+
+@login_required
+async def poll_messages(request, contact_id):
+    """
+    Long-poll API endpoint for clients that can't keep a WebSocket open
+    Joins the conversation's channel layer group (the one ChatConsumer
+    uses) and waits, without holding a thread, for the next chat_message or
+    contact's read_receipt, returning it as the frame a socket would have
+    received. Returns no events after `timeout` seconds (at most
+    LONG_POLL_TIMEOUT).
+    
+    The client sends the same `after` and `read_up_to` as a delta poll of
+    get_messages. If the conversation has already moved past them (say,
+    between two long polls) the response is marked `stale` straight away
+    and the client fetches the delta from get_messages.
+    """
+    # Check if user is verified through calculator
+    if not await request.session.aget('calculator_verified', False):
+        return HttpResponseForbidden()
+    user = await request.auser()
+    
+    max_timeout = getattr(settings, 'LONG_POLL_TIMEOUT', 25)
+    try:
+        after = int(request.GET.get('after') or 0)
+        seen_read_up_to = int(request.GET.get('read_up_to') or 0)
+        timeout = min(float(request.GET.get('timeout') or max_timeout), max_timeout)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid after, read_up_to or timeout'}, status=400)
+    
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return JsonResponse({'status': 'error', 'message': 'Long polling is not available'}, status=503)
+    
+    # Join the group before reading the conversation state, so an event
+    # committed in between is either seen here or delivered to us
+    group = chat_group_name(user.id, contact_id)
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(group, channel)
+    started = time.perf_counter()
+    try:
+        contact_obj = await sync_to_async(conversation_contact)(user, contact_id)
+        if contact_obj is None:
             return JsonResponse({'status': 'error', 'message': 'Invalid contact'})
+        if contact_obj.latest_message_id > after or contact_obj.contact_read_up_to > seen_read_up_to:
+            return JsonResponse({'status': 'success', 'stale': True, 'events': []})
         
-        # Get messages between users
-        messages_query = Message.objects.filter(
-            (Q(sender=request.user) & Q(receiver=contact)) | 
-            (Q(sender=contact) & Q(receiver=request.user))
-        ).order_by('sent_on')
-        
-        # Mark unread messages as read
-        Message.objects.filter(
-            sender=contact,
-            receiver=request.user,
-            is_read=False
-        ).update(is_read=True)
-        
-        # Get user's public key (private key is now stored client-side)
-        try:
-            user_key = MessageKey.objects.get(user=request.user)
-            
-            messages_data = []
-            for msg in messages_query:
-                # Return encrypted content for client-side decryption
-                # For sent messages, try to find a self-copy
-                encrypted_content = msg.content
-                if msg.sender == request.user:
-                    # Try to find a copy of this message where we're the receiver
-                    self_copy = Message.objects.filter(
-                        sender=msg.receiver,
-                        receiver=request.user,
-                        sent_on__gte=msg.sent_on - timezone.timedelta(seconds=2),
-                        sent_on__lte=msg.sent_on + timezone.timedelta(seconds=2)
-                    ).first()
-                    
-                    if self_copy:
-                        # We found a copy we encrypted for ourselves
-                        encrypted_content = self_copy.content
-                
-                # Provide placeholder content (will be decrypted client-side)
-                placeholder_content = "🔒 Encrypted message"
-                    
-                messages_data.append({
-                    'id': msg.id,
-                    'content': placeholder_content,
-                    'encrypted_content': encrypted_content,
-                    'sent_on': msg.sent_on.strftime('%Y-%m-%d %H:%M:%S'),
-                    'sender': msg.sender.username,
-                    'is_self': msg.sender == request.user,
-                    'is_read': msg.is_read
-                })
-            
-            return JsonResponse({'status': 'success', 'messages': messages_data})
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            try:
+                event = await asyncio.wait_for(channel_layer.receive(channel), max(remaining, 0.001))
+            except asyncio.TimeoutError:
+                metrics.incr('long_poll.timeouts')
+                return JsonResponse({'status': 'success', 'stale': False, 'events': []})
             
-        except MessageKey.DoesNotExist:
-            return JsonResponse({'status': 'error', 'message': 'You have no encryption key'})
+            if event['type'] == 'contact_removed' and event['owner_id'] == user.id:
+                return JsonResponse({'status': 'error', 'message': 'Invalid contact'})
+            # Our own receipts (from another tab) don't change anything we show
+            if event['type'] == 'read_receipt' and event['reader_id'] == user.id:
+                continue
+            frame = long_poll_frame(event, contact_obj.contact_user.id)
+            if frame is not None:
+                break
         
-    except User.DoesNotExist:
-        return JsonResponse({'status': 'error', 'message': 'User does not exist'})
+        # As with get_messages, a message handed to the client counts as read
+        if frame['type'] == 'chat_message' and frame['sender_id'] != user.id:
+            await sync_to_async(mark_conversation_read)(
+                user, contact_obj.contact_user, frame['message_id'], contact_obj.read_up_to
+            )
+        metrics.incr('long_poll.events')
+        return JsonResponse({'status': 'success', 'stale': False, 'events': [frame]})
+    finally:
+        metrics.observe('long_poll.wait_ms', (time.perf_counter() - started) * 1000)
+        await channel_layer.group_discard(group, channel)
 
 @login_required
 def settings_view(request):
@@ -428,16 +617,8 @@ def security_verification_view(request, contact_id):
         user_key = MessageKey.objects.get(user=request.user)
         contact_key = MessageKey.objects.get(user=contact_user)
         
-        # Get or generate security code
-        if not contact.security_code:
-            # Use the signal protocol to generate a security code
-            from .signal_protocol import generate_security_verification_code
-            security_code = generate_security_verification_code(
-                user_key.public_key, 
-                contact_key.public_key
-            )
-            contact.security_code = security_code
-            contact.save()
+        # Get the security code (derived from the stored key fingerprints once)
+        security_code = contact.ensure_security_code(user_key, contact_key)
         
         # Handle verification confirmation
         if request.method == 'POST':
@@ -452,12 +633,13 @@ def security_verification_view(request, contact_id):
         from .signal_protocol import generate_qr_verification_data
         qr_data = generate_qr_verification_data(
             user_key.public_key,
-            contact_key.public_key
+            contact_key.public_key,
+            security_code=security_code
         )
         
         return render(request, 'core/security_verification.html', {
             'contact': contact,
-            'security_code': contact.security_code,
+            'security_code': security_code,
             'qr_data': qr_data
         })
     
@@ -500,3 +682,140 @@ def decrypt_message_api(request):
         return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+@login_required
+@csrf_exempt
+def decrypt_messages_api(request):
+    """
+    API endpoint to decrypt a batch of messages with one client-provided private key
+    The key is parsed once and items are decrypted concurrently; each item
+    gets its own result so one bad ciphertext doesn't fail the batch.
+    """
+    # Check if user is verified through calculator
+    if not request.session.get('calculator_verified', False):
+        return JsonResponse({'status': 'error', 'message': 'Authentication required'}, status=403)
+    
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST method required'}, status=405)
+    
+    try:
+        data = json.loads(request.body)
+        encrypted_messages = data.get('encrypted_messages')
+        private_key = data.get('private_key')
+        
+        if not isinstance(encrypted_messages, list) or not private_key:
+            return JsonResponse({'status': 'error', 'message': 'Missing required parameters'}, status=400)
+        
+        if len(encrypted_messages) > settings.DECRYPT_BATCH_LIMIT:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'At most {settings.DECRYPT_BATCH_LIMIT} messages per request'
+            }, status=400)
+        
+        try:
+            decrypted = decrypt_messages(encrypted_messages, private_key, executor=crypto_executor)
+        except Exception as e:
+            # The private key itself could not be parsed
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        
+        results = []
+        for item in decrypted:
+            if isinstance(item, Exception):
+                results.append({'status': 'error', 'message': str(item) or type(item).__name__})
+            else:
+                results.append({'status': 'success', 'decrypted_message': item})
+        
+        return JsonResponse({'status': 'success', 'results': results})
+        
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+@login_required
+def prekey_status(request):
+    """
+    API endpoint telling the client how many one-time pre-keys it has left
+    and whether it should replenish them
+    """
+    if not request.session.get('calculator_verified', False):
+        return HttpResponseForbidden()
+    
+    remaining = prekeys.unused_count(request.user)
+    return JsonResponse({
+        'status': 'success',
+        'remaining': remaining,
+        'low_watermark': prekeys.LOW_WATERMARK,
+        'replenish': remaining <= prekeys.LOW_WATERMARK,
+    })
+
+@login_required
+@require_POST
+def replenish_prekeys(request):
+    """
+    API endpoint to generate a batch of one-time pre-keys for the current user
+    """
+    if not request.session.get('calculator_verified', False):
+        return HttpResponseForbidden()
+    
+    try:
+        count = int(request.POST.get('count') or prekeys.BATCH_SIZE)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid count'}, status=400)
+    
+    if not 0 < count <= prekeys.MAX_BATCH_SIZE:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Count must be between 1 and {prekeys.MAX_BATCH_SIZE}'
+        }, status=400)
+    
+    created = prekeys.generate_one_time_prekeys(request.user, count)
+    return JsonResponse({
+        'status': 'success',
+        'created': len(created),
+        'remaining': prekeys.unused_count(request.user),
+    })
+
+@login_required
+@require_POST
+def claim_prekey(request, contact_id):
+    """
+    API endpoint to claim a contact's pre-key bundle for session setup
+    Each call hands out a different one-time pre-key, or none once they run out.
+    """
+    if not request.session.get('calculator_verified', False):
+        return HttpResponseForbidden()
+    
+    try:
+        contact = User.objects.get(id=contact_id)
+    except User.DoesNotExist:
+        return JsonResponse({'status': 'error', 'message': 'User does not exist'})
+    
+    if not Contact.objects.filter(owner=request.user, contact_user=contact).exists():
+        return JsonResponse({'status': 'error', 'message': 'Invalid contact'})
+    
+    signed_prekey = SignedPreKey.objects.filter(user=contact).order_by('-key_id').first()
+    one_time_prekey = prekeys.claim_one_time_prekey(contact, request.user)
+    
+    return JsonResponse({
+        'status': 'success',
+        'signed_prekey': {
+            'key_id': signed_prekey.key_id,
+            'public_key': base64_encode(bytes(signed_prekey.public_key)),
+            'signature': signed_prekey.signature,
+        } if signed_prekey else None,
+        'one_time_prekey': {
+            'key_id': one_time_prekey.key_id,
+            'public_key': base64_encode(bytes(one_time_prekey.public_key)),
+        } if one_time_prekey else None,
+    })
+
+@login_required
+def metrics_view(request):
+    """
+    API endpoint returning this process's internal metrics (staff only)
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    
+    return JsonResponse({'status': 'success', 'metrics': metrics.snapshot()})